@@ -0,0 +1,610 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# In-memory stand-in for the EC2 Query API, covering the actions used by
+# the plugin. Request signatures are not checked.
+#
+#   python benchmarks/fake_ec2.py --port 8773 --instances 10000
+
+
+import argparse
+import BaseHTTPServer
+import collections
+import fnmatch
+import itertools
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+from xml.sax.saxutils import escape
+
+
+NAMESPACE = 'http://ec2.amazonaws.com/doc/2013-10-15/'
+OWNER_ID = '123456789012'
+AVAILABILITY_ZONE = 'us-east-1a'
+IMAGE_NAME_TEMPLATE = 'benchmark-image-{0}'
+# How long terminated instances stay visible, as on EC2
+TERMINATED_TTL = 60
+
+# Transient states move on after being described this many times
+TRANSITIONS = {
+    'pending': ('running', 1),
+    'stopping': ('stopped', 1),
+    'shutting-down': ('terminated', 1),
+}
+
+
+class EC2Error(Exception):
+
+    def __init__(self, code, message, status=400):
+        super(EC2Error, self).__init__(message)
+        self.code = code
+        self.status = status
+
+
+def _indexed(params, prefix):
+    # Collects "Prefix.N" and "Prefix.N.Field" parameters into a list
+    # ordered by N. libcloud numbers some of them from 0, others from 1.
+    pattern = re.compile(r'^{0}\.(\d+)(?:\.(.+))?$'.format(re.escape(prefix)))
+    items = collections.defaultdict(dict)
+    for key, value in params.items():
+        match = pattern.match(key)
+        if match:
+            items[int(match.group(1))][match.group(2)] = value
+    return [items[i] for i in sorted(items)]
+
+
+def _values(params, prefix):
+    return [item[None] for item in _indexed(params, prefix)]
+
+
+def _filters(params):
+    filters = {}
+    for item in _indexed(params, 'Filter'):
+        filters[item['Name']] = [value for key, value in sorted(item.items())
+                                 if key and key.startswith('Value.')]
+    return filters
+
+
+def _matches(values, patterns):
+    return any(fnmatch.fnmatchcase(value or '', pattern)
+               for value in values for pattern in patterns)
+
+
+def _xml(tag, value):
+    if value is None:
+        return '<{0}/>'.format(tag)
+    return '<{0}>{1}</{0}>'.format(tag, escape(str(value)))
+
+
+def _items(tag, elements):
+    return '<{0}>{1}</{0}>'.format(
+        tag, ''.join('<item>{0}</item>'.format(e) for e in elements))
+
+
+class FakeEC2(object):
+
+    def __init__(self, instances=0, addresses=0, images=1, latency=0.0,
+                 rate_limit=None):
+        self.latency = latency
+        # Requests per second and burst size, like EC2's own throttling
+        self.rate_limit = rate_limit
+        self._tokens = rate_limit
+        self._refilled_at = time.time()
+        self.calls = collections.Counter()
+        self.instances = collections.OrderedDict()
+        self.addresses = collections.OrderedDict()
+        self.security_groups = collections.OrderedDict()
+        self.images = collections.OrderedDict()
+        self._client_tokens = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        for i in range(images):
+            image_id = 'ami-{0:08x}'.format(i + 1)
+            self.images[image_id] = IMAGE_NAME_TEMPLATE.format(i)
+        for i in range(instances):
+            self._run_instance('ami-00000001', 'm1.small', None, [],
+                               state='running',
+                               tags={'Name': 'existing-{0}'.format(i)})
+        instance_ids = list(self.instances)
+        for i in range(addresses):
+            ip = self._next_address()
+            # Half of the pre-allocated addresses are associated
+            if i % 2 == 0 and instance_ids:
+                self.addresses[ip] = instance_ids[i % len(instance_ids)]
+
+    def handle(self, params):
+        if self.latency:
+            time.sleep(self.latency)
+        action = params.get('Action')
+        handler = getattr(self, '_' + (action or ''), None)
+        with self._lock:
+            self.calls[action] += 1
+            self._throttle()
+            if handler is None:
+                raise EC2Error('InvalidAction',
+                               'The action {0} is not valid'.format(action))
+            body = handler(params)
+        return ('<{0}Response xmlns="{1}"><requestId>{2}</requestId>'
+                '{3}</{0}Response>'.format(action, NAMESPACE, uuid.uuid4(),
+                                           body))
+
+    def _throttle(self):
+        if not self.rate_limit:
+            return
+        now = time.time()
+        self._tokens = min(self.rate_limit, self._tokens +
+                           (now - self._refilled_at) * self.rate_limit)
+        self._refilled_at = now
+        if self._tokens < 1:
+            raise EC2Error('RequestLimitExceeded', 'Request limit exceeded.',
+                           status=503)
+        self._tokens -= 1
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _next_id(self, prefix):
+        return '{0}-{1:08x}'.format(prefix, next(self._ids))
+
+    def _next_address(self):
+        n = next(self._ids)
+        ip = '198.{0}.{1}.{2}'.format((n >> 16) & 255, (n >> 8) & 255,
+                                      n & 255)
+        self.addresses[ip] = None
+        return ip
+
+    def _run_instance(self, image_id, instance_type, key_name, groups,
+                      state='pending', tags=None, client_token=None):
+        instance_id = self._next_id('i')
+        n = len(self.instances) + 1
+        self.instances[instance_id] = {
+            'id': instance_id,
+            'image_id': image_id,
+            'type': instance_type,
+            'key_name': key_name,
+            'groups': groups,
+            'state': state,
+            'seen': 0,
+            'terminated_at': None,
+            'private_ip': '10.{0}.{1}.{2}'.format((n >> 16) & 255,
+                                                  (n >> 8) & 255,
+                                                  n & 255),
+            'tags': dict(tags or {}),
+            'client_token': client_token,
+        }
+        return self.instances[instance_id]
+
+    def _instances(self, ids):
+        missing = [i for i in ids if i not in self.instances]
+        if missing:
+            raise EC2Error('InvalidInstanceID.NotFound',
+                           "The instance IDs '{0}' do not exist".format(
+                               ', '.join(missing)))
+        return [self.instances[i] for i in ids]
+
+    def _public_ips(self):
+        return dict((instance_id, ip)
+                    for ip, instance_id in self.addresses.items()
+                    if instance_id)
+
+    def _instance_xml(self, instance, public_ips):
+        return ''.join([
+            _xml('instanceId', instance['id']),
+            _xml('imageId', instance['image_id']),
+            '<instanceState>{0}{1}</instanceState>'.format(
+                _xml('code', 16), _xml('name', instance['state'])),
+            _xml('privateDnsName', None),
+            _xml('dnsName', None),
+            _xml('keyName', instance['key_name']),
+            _xml('instanceType', instance['type']),
+            _xml('launchTime', '2014-01-01T00:00:00.000Z'),
+            '<placement>{0}</placement>'.format(
+                _xml('availabilityZone', AVAILABILITY_ZONE)),
+            _xml('privateIpAddress', instance['private_ip']),
+            _xml('ipAddress', public_ips.get(instance['id'])),
+            _items('groupSet', [_xml('groupId', g) for g in
+                                instance['groups']]),
+            _items('tagSet', [_xml('key', k) + _xml('value', v)
+                              for k, v in sorted(
+                                  instance['tags'].items())]),
+        ])
+
+    def _advance(self, instance):
+        # Called when an instance is described
+        transition = TRANSITIONS.get(instance['state'])
+        if transition is not None:
+            instance['seen'] += 1
+            if instance['seen'] > transition[1]:
+                instance['state'] = transition[0]
+                instance['seen'] = 0
+                if instance['state'] == 'terminated':
+                    instance['terminated_at'] = time.time()
+
+    def _purge_terminated(self):
+        now = time.time()
+        for instance_id, instance in self.instances.items():
+            if instance['terminated_at'] and \
+                    now - instance['terminated_at'] > TERMINATED_TTL:
+                del self.instances[instance_id]
+
+    def _instance_filter(self, instance, name, patterns):
+        if name == 'instance-id':
+            return _matches([instance['id']], patterns)
+        if name == 'instance-state-name':
+            return _matches([instance['state']], patterns)
+        if name == 'client-token':
+            return _matches([instance['client_token']], patterns)
+        if name.startswith('tag:'):
+            return _matches([instance['tags'].get(name[4:])], patterns)
+        raise EC2Error('InvalidParameterValue',
+                       "The filter '{0}' is invalid".format(name))
+
+    def _DescribeInstances(self, params):
+        self._purge_terminated()
+        ids = _values(params, 'InstanceId')
+        instances = self._instances(ids) if ids else \
+            self.instances.values()
+        for name, patterns in _filters(params).items():
+            instances = [i for i in instances
+                         if self._instance_filter(i, name, patterns)]
+        public_ips = self._public_ips()
+        for instance in instances:
+            self._advance(instance)
+        if not instances:
+            return '<reservationSet/>'
+        return _items('reservationSet', [''.join([
+            _xml('reservationId', 'r-00000000'),
+            _xml('ownerId', OWNER_ID),
+            '<groupSet/>',
+            _items('instancesSet', [self._instance_xml(i, public_ips)
+                                    for i in instances])])])
+
+    def _RunInstances(self, params):
+        token = params.get('ClientToken')
+        if token and token in self._client_tokens:
+            instances = self._client_tokens[token]
+        else:
+            if params.get('ImageId') not in self.images:
+                raise EC2Error('InvalidAMIID.NotFound',
+                               "The image id '[{0}]' does not exist".format(
+                                   params.get('ImageId')))
+            groups = [self._group_by_name(name)
+                      for name in _values(params, 'SecurityGroup')]
+            instances = [
+                self._run_instance(params['ImageId'],
+                                   params.get('InstanceType'),
+                                   params.get('KeyName'),
+                                   [g['id'] for g in groups],
+                                   client_token=token)
+                for _ in range(int(params.get('MaxCount', 1)))]
+            if token:
+                self._client_tokens[token] = instances
+        return ''.join([
+            _xml('reservationId', 'r-00000000'),
+            _xml('ownerId', OWNER_ID),
+            '<groupSet/>',
+            _items('instancesSet', [self._instance_xml(i, {})
+                                    for i in instances])])
+
+    def _CreateTags(self, params):
+        tags = dict((t['Key'], t.get('Value', ''))
+                    for t in _indexed(params, 'Tag'))
+        for resource_id in _values(params, 'ResourceId'):
+            if resource_id in self.instances:
+                self.instances[resource_id]['tags'].update(tags)
+        return _xml('return', 'true')
+
+    def _change_states(self, params, state):
+        instances = self._instances(_values(params, 'InstanceId'))
+        items = []
+        for instance in instances:
+            previous = instance['state']
+            if previous != 'terminated':
+                instance['state'] = state
+                instance['seen'] = 0
+            items.append(''.join([
+                _xml('instanceId', instance['id']),
+                '<currentState>{0}</currentState>'.format(
+                    _xml('name', instance['state'])),
+                '<previousState>{0}</previousState>'.format(
+                    _xml('name', previous))]))
+        return _items('instancesSet', items)
+
+    def _TerminateInstances(self, params):
+        for instance_id in _values(params, 'InstanceId'):
+            for ip, associated in self.addresses.items():
+                if associated == instance_id:
+                    self.addresses[ip] = None
+        return self._change_states(params, 'shutting-down')
+
+    def _StartInstances(self, params):
+        return self._change_states(params, 'pending')
+
+    def _StopInstances(self, params):
+        return self._change_states(params, 'stopping')
+
+    def _address_xml(self, ip):
+        return ''.join([_xml('publicIp', ip),
+                        _xml('domain', 'standard'),
+                        _xml('instanceId', self.addresses[ip])])
+
+    def _DescribeAddresses(self, params):
+        ips = _values(params, 'PublicIp')
+        missing = [ip for ip in ips if ip not in self.addresses]
+        if missing:
+            raise EC2Error('InvalidAddress.NotFound',
+                           "Address '{0}' not found.".format(missing[0]))
+        ips = ips or self.addresses.keys()
+        for name, patterns in _filters(params).items():
+            if name == 'public-ip':
+                ips = [ip for ip in ips if _matches([ip], patterns)]
+            elif name == 'instance-id':
+                ips = [ip for ip in ips
+                       if _matches([self.addresses[ip]], patterns)]
+            else:
+                raise EC2Error('InvalidParameterValue',
+                               "The filter '{0}' is invalid".format(name))
+        return _items('addressesSet', [self._address_xml(ip) for ip in ips])
+
+    def _address(self, params):
+        ip = params.get('PublicIp')
+        if ip not in self.addresses:
+            raise EC2Error('InvalidAddress.NotFound',
+                           "Address '{0}' not found.".format(ip))
+        return ip
+
+    def _AllocateAddress(self, params):
+        ip = self._next_address()
+        return _xml('publicIp', ip) + _xml('domain', 'standard')
+
+    def _ReleaseAddress(self, params):
+        del self.addresses[self._address(params)]
+        return _xml('return', 'true')
+
+    def _AssociateAddress(self, params):
+        ip = self._address(params)
+        self._instances([params.get('InstanceId')])
+        self.addresses[ip] = params['InstanceId']
+        return _xml('return', 'true')
+
+    def _DisassociateAddress(self, params):
+        self.addresses[self._address(params)] = None
+        return _xml('return', 'true')
+
+    def _DescribeImages(self, params):
+        ids = _values(params, 'ImageId')
+        images = [(i, self.images[i]) for i in ids if i in self.images] \
+            if ids else self.images.items()
+        for name, patterns in _filters(params).items():
+            if name == 'name':
+                images = [i for i in images if _matches([i[1]], patterns)]
+            elif name == 'image-id':
+                images = [i for i in images if _matches([i[0]], patterns)]
+            elif name == 'state':
+                # Every image is available
+                images = images if _matches(['available'], patterns) else []
+        return _items('imagesSet', [''.join([
+            _xml('imageId', image_id),
+            _xml('imageLocation', '{0}/{1}'.format(OWNER_ID, name)),
+            _xml('imageState', 'available'),
+            _xml('imageOwnerId', OWNER_ID),
+            _xml('isPublic', 'false'),
+            _xml('architecture', 'x86_64'),
+            _xml('imageType', 'machine'),
+            _xml('name', name),
+            _xml('rootDeviceType', 'ebs'),
+            _xml('virtualizationType', 'paravirtual'),
+            _xml('hypervisor', 'xen')]) for image_id, name in images])
+
+    def _group_by_name(self, name):
+        for group in self.security_groups.values():
+            if group['name'] == name:
+                return group
+        raise EC2Error('InvalidGroup.NotFound',
+                       "The security group '{0}' does not exist".format(name))
+
+    def _group(self, params):
+        group_id = params.get('GroupId')
+        if group_id not in self.security_groups:
+            raise EC2Error('InvalidGroup.NotFound',
+                           "The security group '{0}' does not exist".format(
+                               group_id))
+        return self.security_groups[group_id]
+
+    def _group_xml(self, group):
+        by_ports = collections.defaultdict(lambda: ([], []))
+        for protocol, from_port, to_port, kind, value in \
+                sorted(group['rules']):
+            by_ports[(protocol, from_port, to_port)][
+                kind == 'cidr'].append(value)
+        permissions = []
+        for (protocol, from_port, to_port), (group_ids, cidrs) in \
+                sorted(by_ports.items()):
+            permissions.append(''.join([
+                _xml('ipProtocol', protocol),
+                _xml('fromPort', from_port),
+                _xml('toPort', to_port),
+                _items('groups', [_xml('userId', OWNER_ID) +
+                                  _xml('groupId', g) for g in group_ids]),
+                _items('ipRanges', [_xml('cidrIp', c) for c in cidrs])]))
+        return ''.join([
+            _xml('ownerId', OWNER_ID),
+            _xml('groupId', group['id']),
+            _xml('groupName', group['name']),
+            _xml('groupDescription', group['description']),
+            _items('ipPermissions', permissions),
+            '<ipPermissionsEgress/>'])
+
+    def _DescribeSecurityGroups(self, params):
+        groups = self.security_groups.values()
+        names = _values(params, 'GroupName')
+        if names:
+            groups = [self._group_by_name(name) for name in names]
+        ids = _values(params, 'GroupId')
+        if ids:
+            groups = [self._group({'GroupId': i}) for i in ids]
+        for name, patterns in _filters(params).items():
+            if name == 'group-name':
+                groups = [g for g in groups
+                          if _matches([g['name']], patterns)]
+            elif name == 'group-id':
+                groups = [g for g in groups if _matches([g['id']], patterns)]
+            else:
+                raise EC2Error('InvalidParameterValue',
+                               "The filter '{0}' is invalid".format(name))
+        return _items('securityGroupInfo',
+                      [self._group_xml(g) for g in groups])
+
+    def _CreateSecurityGroup(self, params):
+        name = params.get('GroupName')
+        if any(g['name'] == name for g in self.security_groups.values()):
+            raise EC2Error('InvalidGroup.Duplicate',
+                           "The security group '{0}' already exists".format(
+                               name))
+        group_id = self._next_id('sg')
+        self.security_groups[group_id] = {
+            'id': group_id,
+            'name': name,
+            'description': params.get('GroupDescription'),
+            'rules': set(),
+        }
+        return _xml('return', 'true') + _xml('groupId', group_id)
+
+    def _DeleteSecurityGroup(self, params):
+        del self.security_groups[self._group(params)['id']]
+        return _xml('return', 'true')
+
+    def _permissions(self, params):
+        rules = []
+        for permission in _indexed(params, 'IpPermissions'):
+            ports = (permission.get('IpProtocol'),
+                     permission.get('FromPort'),
+                     permission.get('ToPort'))
+            for key, value in sorted(permission.items()):
+                if re.match(r'^Groups\.\d+\.GroupId$', key or ''):
+                    rules.append(ports + ('group', value))
+                elif re.match(r'^IpRanges\.\d+\.CidrIp$', key or ''):
+                    rules.append(ports + ('cidr', value))
+        return rules
+
+    def _AuthorizeSecurityGroupIngress(self, params):
+        group = self._group(params)
+        rules = self._permissions(params)
+        duplicates = [r for r in rules if r in group['rules']]
+        if duplicates:
+            raise EC2Error('InvalidPermission.Duplicate',
+                           'the specified rule "{0}" already exists'.format(
+                               duplicates[0]))
+        group['rules'].update(rules)
+        return _xml('return', 'true')
+
+    def _RevokeSecurityGroupIngress(self, params):
+        group = self._group(params)
+        rules = self._permissions(params)
+        missing = [r for r in rules if r not in group['rules']]
+        if missing:
+            raise EC2Error('InvalidPermission.NotFound',
+                           'The specified rule does not exist in this '
+                           'security group.')
+        group['rules'].difference_update(rules)
+        return _xml('return', 'true')
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep their connections open
+    protocol_version = 'HTTP/1.1'
+    # Buffered, so a response leaves in one segment instead of stalling
+    # on delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        self._respond(query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self._respond(self.rfile.read(length))
+
+    def _respond(self, query):
+        params = dict((k, v[-1]) for k, v in
+                      urlparse.parse_qs(query, keep_blank_values=True)
+                      .items())
+        try:
+            status, body = 200, self.server.ec2.handle(params)
+        except EC2Error as e:
+            status = e.status
+            body = ('<Response><Errors><Error>{0}{1}</Error></Errors>'
+                    '<RequestID>{2}</RequestID></Response>'.format(
+                        _xml('Code', e.code), _xml('Message', str(e)),
+                        uuid.uuid4()))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEC2Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, ec2, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           _RequestHandler)
+        self.ec2 = ec2
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='In-memory stand-in for the EC2 Query API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8773)
+    parser.add_argument('--instances', type=int, default=0)
+    parser.add_argument('--addresses', type=int, default=0)
+    parser.add_argument('--images', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--rate-limit', type=float,
+                        help='requests per second before throttling')
+    args = parser.parse_args()
+    ec2 = FakeEC2(instances=args.instances,
+                  addresses=args.addresses,
+                  images=args.images,
+                  latency=args.latency,
+                  rate_limit=args.rate_limit)
+    server = FakeEC2Server(ec2, host=args.host, port=args.port)
+    print 'Fake EC2 endpoint listening on {0}:{1}'.format(args.host,
+                                                          server.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
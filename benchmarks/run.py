@@ -0,0 +1,400 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Runs the plugin operations through mocked Cloudify contexts against the
+# fake EC2 endpoint and reports ops/sec, p50/p99 latency and API calls per
+# operation. Each iteration takes one security group, server and floating
+# IP through their whole lifecycle; every operation runs as a phase of
+# its own across all iterations. The plugin must be installed, e.g. with
+# "pip install -e .".
+#
+#   python benchmarks/run.py --instances 10000 --addresses 5000
+#   python benchmarks/run.py --json results.json
+#   python benchmarks/run.py --baseline results.json
+
+
+import argparse
+import collections
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from cloudify.exceptions import RecoverableError
+from cloudify.mocks import (MockCloudifyContext,
+                            MockContext,
+                            MockNodeContext,
+                            MockNodeInstanceContext)
+
+from fake_ec2 import FakeEC2, FakeEC2Server, IMAGE_NAME_TEMPLATE
+from floating_ip_plugin import floating_ip
+from libcloud_plugin_common.metrics import api_metrics
+from security_group_plugin import security_group
+from server_plugin import server
+
+
+SIZE_NAME = 'm1.small'
+KEY_NAME = 'benchmark'
+DEPLOYMENT_ID = 'benchmark'
+
+
+class Iteration(object):
+
+    def __init__(self, prefix, index, rules, server_security_group=None):
+        name = '{0}_{1}'.format(prefix, index)
+        self.ids = {
+            'security_group': 'security_group_' + name,
+            'server': 'server_' + name,
+            'floating_ip': 'floating_ip_' + name,
+        }
+        self.runtime_properties = dict((kind, {}) for kind in self.ids)
+        self.properties = {
+            'security_group': {
+                'security_group': {'name': self.ids['security_group'],
+                                   'description': 'benchmark'},
+                'rules': [{'port': 1000 + i,
+                           'remote_ip_prefix': '10.{0}.0.0/16'.format(i)}
+                          for i in range(rules)],
+                'disable_egress': False,
+                'reconcile_rules': False,
+                'compact_rules': False,
+            },
+            'server': {
+                'server': {'image_name': IMAGE_NAME_TEMPLATE.format(0),
+                           'size_name': SIZE_NAME,
+                           'key_name': KEY_NAME,
+                           'security_groups': [server_security_group or
+                                               self.ids['security_group']]},
+                'non_blocking_waits': False,
+                'batch_provisioning': False,
+                'async_delete': False,
+                'batch_termination': False,
+            },
+            'floating_ip': {
+                'floatingip': {},
+            },
+        }
+
+    def node_ctx(self, kind, task_name):
+        ctx = MockCloudifyContext(
+            node_id=self.ids[kind],
+            deployment_id=DEPLOYMENT_ID,
+            node_name=kind,
+            properties=self.properties[kind],
+            runtime_properties=self.runtime_properties[kind])
+        return _with_task_name(ctx, task_name)
+
+    def relationship_ctx(self, source, target, task_name):
+        ctx = MockCloudifyContext(deployment_id=DEPLOYMENT_ID,
+                                  source=self._endpoint(source),
+                                  target=self._endpoint(target))
+        return _with_task_name(ctx, task_name)
+
+    def _endpoint(self, kind):
+        return MockContext({
+            'node': MockNodeContext(kind, self.properties[kind]),
+            'instance': MockNodeInstanceContext(
+                self.ids[kind], self.runtime_properties[kind]),
+        })
+
+
+def _with_task_name(ctx, task_name):
+    # API metrics are recorded per task name, which the mock context
+    # does not take as an argument
+    ctx._context['task_name'] = task_name
+    return ctx
+
+
+def _node_operation(kind, func):
+    def run(iteration, name):
+        ctx = iteration.node_ctx(kind, name)
+        try:
+            func(ctx=ctx)
+        finally:
+            # The mock context replaces empty runtime properties with a
+            # new dict, so they are carried over from it explicitly
+            iteration.runtime_properties[kind] = \
+                ctx.instance.runtime_properties
+    return run
+
+
+def _relationship_operation(source, target, func):
+    def run(iteration, name):
+        func(ctx=iteration.relationship_ctx(source, target, name))
+    return run
+
+
+OPERATIONS = collections.OrderedDict([
+    ('security_group.create',
+     _node_operation('security_group', security_group.create)),
+    ('server.start', _node_operation('server', server.start)),
+    ('server.get_state', _node_operation('server', server.get_state)),
+    ('floating_ip.create',
+     _node_operation('floating_ip', floating_ip.create)),
+    ('server.connect_floating_ip',
+     _relationship_operation('server', 'floating_ip',
+                             server.connect_floating_ip)),
+    ('server.disconnect_floating_ip',
+     _relationship_operation('server', 'floating_ip',
+                             server.disconnect_floating_ip)),
+    ('floating_ip.delete',
+     _node_operation('floating_ip', floating_ip.delete)),
+    ('server.stop', _node_operation('server', server.stop)),
+    ('server.delete', _node_operation('server', server.delete)),
+    ('security_group.delete',
+     _node_operation('security_group', security_group.delete)),
+])
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def _run_phase(pool, name, iterations, retry_interval):
+    # Operations failing with RecoverableError are retried in rounds, as
+    # Cloudify would retry the task, without holding a worker meanwhile.
+    # Their latency spans from the first attempt to the last.
+    func = OPERATIONS[name]
+    started = {}
+
+    def run(iteration):
+        started.setdefault(iteration, time.time())
+        try:
+            func(iteration, name)
+        except RecoverableError as e:
+            return time.time(), e, True
+        except Exception as e:
+            return time.time(), e, False
+        return time.time(), None, False
+
+    start = time.time()
+    pending = iterations
+    latencies = []
+    errors = []
+    retries = 0
+    while pending:
+        outcomes = pool.map(run, pending)
+        retry = []
+        for iteration, (finished, error, recoverable) in \
+                zip(pending, outcomes):
+            if recoverable:
+                retry.append(iteration)
+                continue
+            latencies.append(finished - started[iteration])
+            if error is not None:
+                errors.append(error)
+        if retry:
+            retries += len(retry)
+            time.sleep(retry_interval)
+        pending = retry
+    elapsed = time.time() - start
+    return {
+        'ops_per_sec': len(iterations) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'retries': retries,
+        'errors': len(errors),
+        'first_error': str(errors[0]) if errors else None,
+    }
+
+
+def _api_calls(name, count):
+    calls = {}
+    throttles = 0
+    for (operation, action), series in api_metrics.snapshot().items():
+        if operation == name:
+            calls[action] = series['count'] / float(count)
+            throttles += series['throttles']
+    return calls, throttles
+
+
+def write_connection_config(host, port, state_dir, api_rate_limit):
+    config = {
+        'cloud_provider_name': 'ec2-us-east',
+        'access_id': 'benchmark',
+        'secret_key': 'benchmark',
+        'endpoint_host': host,
+        'endpoint_port': port,
+        'endpoint_secure': False,
+        'api_rate_state_dir': state_dir,
+        'launch_journal_dir': os.path.join(state_dir, 'launches'),
+        'api_rate_limit': api_rate_limit,
+    }
+    fd, path = tempfile.mkstemp(prefix='libcloud-benchmark-',
+                                suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def _report(results):
+    print '{0:<30} {1:>9} {2:>9} {3:>9} {4:>10} {5:>9} {6:>7} ' \
+        '{7:>7}'.format('operation', 'ops/sec', 'p50 ms', 'p99 ms',
+                        'API calls', 'throttled', 'retries', 'errors')
+    for name, result in results.items():
+        print '{0:<30} {1:>9.1f} {2:>9.1f} {3:>9.1f} {4:>10.1f} {5:>9} ' \
+            '{6:>7} {7:>7}'.format(name,
+                                   result['ops_per_sec'],
+                                   result['p50'] * 1000,
+                                   result['p99'] * 1000,
+                                   sum(result['api_calls'].values()),
+                                   result['throttles'],
+                                   result['retries'],
+                                   result['errors'])
+        print '    ' + ', '.join('{0} {1:g}'.format(action, calls)
+                                 for action, calls in
+                                 sorted(result['api_calls'].items()))
+        if result['first_error']:
+            print '    first error: ' + result['first_error']
+
+
+def _regressions(results, baseline, tolerance):
+    # API call counts are deterministic and must not grow; latency may
+    # grow by the given fraction
+    found = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        calls = sum(result['api_calls'].values())
+        previous_calls = sum(previous['api_calls'].values())
+        if calls > previous_calls:
+            found.append('{0}: {1:g} API calls per operation, was '
+                         '{2:g}'.format(name, calls, previous_calls))
+        if result['p50'] > previous['p50'] * (1 + tolerance):
+            found.append('{0}: p50 latency {1:.1f} ms, was {2:.1f} ms'.format(
+                name, result['p50'] * 1000, previous['p50'] * 1000))
+        if result['errors'] > previous['errors']:
+            found.append('{0}: {1} errors, was {2}'.format(
+                name, result['errors'], previous['errors']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark plugin operations against a fake EC2 '
+                    'endpoint')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--instances', type=int, default=200,
+                        help='instances already in the inventory')
+    parser.add_argument('--addresses', type=int, default=100,
+                        help='addresses already allocated')
+    parser.add_argument('--images', type=int, default=100)
+    parser.add_argument('--rules', type=int, default=10,
+                        help='rules per security group')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every API request')
+    parser.add_argument('--rate-limit', type=float,
+                        help='requests per second the endpoint allows '
+                             'before throttling')
+    parser.add_argument('--api-rate-limit', type=float, default=0,
+                        help="the plugin's own api_rate_limit, off by "
+                             "default")
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+                        help='initial sleep between server state polls')
+    parser.add_argument('--retry-interval', type=float, default=0.05,
+                        help='delay before retrying operations that '
+                             'raised RecoverableError')
+    parser.add_argument('--batch-provisioning', action='store_true')
+    parser.add_argument('--non-blocking-waits', action='store_true')
+    parser.add_argument('--async-delete', action='store_true')
+    parser.add_argument('--batch-termination', action='store_true')
+    parser.add_argument('--endpoint',
+                        help='host:port of a running fake_ec2.py; one is '
+                             'started in process otherwise')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='results file of an earlier run; exits with '
+                             'status 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p50 latency growth over the '
+                             'baseline')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    if args.endpoint:
+        host, _, port = args.endpoint.rpartition(':')
+        port = int(port)
+    else:
+        ec2 = FakeEC2(instances=args.instances,
+                      addresses=args.addresses,
+                      images=args.images,
+                      latency=args.latency,
+                      rate_limit=args.rate_limit)
+        host, port = '127.0.0.1', FakeEC2Server(ec2).start().port
+    # A bucket of its own, so other runs on the host do not interfere
+    state_dir = tempfile.mkdtemp(prefix='libcloud-benchmark-')
+    config_path = write_connection_config(host, port, state_dir,
+                                          args.api_rate_limit)
+    os.environ['CONNECTION_CONFIG_PATH'] = config_path
+    server.SLEEP_TIME = args.poll_interval
+
+    prefix = uuid.uuid4().hex[:8]
+    # One group for all servers, so that their launches can be batched
+    servers = Iteration(prefix, 'servers', 0)
+    iterations = [Iteration(prefix, i, args.rules,
+                            servers.ids['security_group'])
+                  for i in range(args.iterations)]
+    for iteration in iterations:
+        iteration.properties['server'].update(
+            batch_provisioning=args.batch_provisioning,
+            non_blocking_waits=args.non_blocking_waits,
+            async_delete=args.async_delete,
+            batch_termination=args.batch_termination)
+
+    pool = ThreadPool(args.concurrency)
+    results = collections.OrderedDict()
+    try:
+        OPERATIONS['security_group.create'](servers, 'security_group.create')
+        for name in OPERATIONS:
+            api_metrics.reset()
+            results[name] = _run_phase(pool, name, iterations,
+                                       args.retry_interval)
+            results[name]['api_calls'], results[name]['throttles'] = \
+                _api_calls(name, len(iterations))
+        OPERATIONS['security_group.delete'](servers, 'security_group.delete')
+    finally:
+        pool.close()
+        os.remove(config_path)
+        shutil.rmtree(state_dir)
+
+    _report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _regressions(results, json.load(f),
+                                       args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION ' + regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
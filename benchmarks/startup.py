@@ -0,0 +1,99 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Measures the cold start of a worker: each sample is a fresh interpreter
+# that imports the plugin's operation modules and runs one operation
+# against the fake EC2 endpoint.
+#
+#   python benchmarks/startup.py --samples 20
+
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def child():
+    start = time.time()
+    from floating_ip_plugin import floating_ip
+    import security_group_plugin.security_group  # NOQA
+    import server_plugin.server  # NOQA
+    imported = time.time()
+
+    logging.disable(logging.CRITICAL)
+    from cloudify.mocks import MockCloudifyContext
+    ctx = MockCloudifyContext(node_id='floating_ip_startup',
+                              node_name='floating_ip',
+                              properties={'floatingip': {}})
+    operation_start = time.time()
+    floating_ip.create(ctx=ctx)
+    finished = time.time()
+    print json.dumps({
+        'import': imported - start,
+        'first_operation': finished - operation_start,
+        'modules': len(sys.modules),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark import and first operation latency')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    # Not imported by children, run imports the plugin
+    from fake_ec2 import FakeEC2, FakeEC2Server
+    from run import percentile, write_connection_config
+    port = FakeEC2Server(FakeEC2()).start().port
+    state_dir = tempfile.mkdtemp(prefix='libcloud-benchmark-')
+    config_path = write_connection_config('127.0.0.1', port, state_dir, 0)
+    env = dict(os.environ, CONNECTION_CONFIG_PATH=config_path)
+    samples = []
+    try:
+        for _ in range(args.samples):
+            start = time.time()
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--child'],
+                env=env)
+            sample = json.loads(output.splitlines()[-1])
+            sample['total'] = time.time() - start
+            samples.append(sample)
+    finally:
+        os.remove(config_path)
+        shutil.rmtree(state_dir)
+
+    print '{0:<20} {1:>9} {2:>9}'.format('phase', 'p50 ms', 'p99 ms')
+    for phase in ('import', 'first_operation', 'total'):
+        values = [s[phase] for s in samples]
+        print '{0:<20} {1:>9.1f} {2:>9.1f}'.format(
+            phase,
+            percentile(values, 50) * 1000,
+            percentile(values, 99) * 1000)
+    print 'modules loaded: {0}'.format(samples[-1]['modules'])
+
+
+if __name__ == '__main__':
+    main()
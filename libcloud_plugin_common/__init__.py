@@ -15,18 +15,33 @@
 
 
 import abc
+import collections
+import errno
+import hashlib
+import httplib
 import json
+import math
 import os
+import Queue
+import random
+import socket
+import struct
 import sys
+import threading
+import time
 
 from functools import wraps
 
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-
-from cloudify import context
 from cloudify.exceptions import NonRecoverableError, RecoverableError
 
+from libcloud_plugin_common.metrics import api_metrics
+from libcloud_plugin_common.rate_limit import rate_limiter
+from libcloud_plugin_common.regions import region_stats
+
+
+# Cloud provider name of the region a server was placed in
+LIBCLOUD_REGION_PROPERTY = 'libcloud_region'
+
 
 class LibcloudProviderContext(object):
 
@@ -77,6 +92,62 @@ def transform_resource_name(res, ctx):
     return res['name']
 
 
+def _normalize_cidr(cidr):
+    if not cidr:
+        return None
+    cidr = str(cidr).strip().lower()
+    address, _, prefix = cidr.partition('/')
+    try:
+        packed = struct.unpack('!I', socket.inet_aton(address))[0]
+    except socket.error:
+        # Not IPv4, keep it as given
+        return cidr
+    prefix = int(prefix or 32)
+    mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+    network = socket.inet_ntoa(struct.pack('!I', packed & mask))
+    return '{0}/{1}'.format(network, prefix)
+
+
+def _normalize_port(port):
+    # EC2 omits the ports of rules that cover every port
+    return -1 if port is None else int(port)
+
+
+class SecurityGroupRule(collections.namedtuple('SecurityGroupRule', [
+        'direction',
+        'protocol',
+        'port_range_min',
+        'port_range_max',
+        'remote_ip_prefix',
+        'remote_group_id'])):
+    __slots__ = ()
+
+    @classmethod
+    def normalized(cls,
+                   protocol,
+                   port_range_min,
+                   port_range_max,
+                   remote_ip_prefix=None,
+                   remote_group_id=None,
+                   direction='ingress'):
+        return cls(direction,
+                   str(protocol).lower(),
+                   _normalize_port(port_range_min),
+                   _normalize_port(port_range_max),
+                   None if remote_group_id else
+                   _normalize_cidr(remote_ip_prefix),
+                   remote_group_id or None)
+
+    @classmethod
+    def from_dict(cls, rule):
+        return cls.normalized(rule['protocol'],
+                              rule['port_range_min'],
+                              rule['port_range_max'],
+                              remote_ip_prefix=rule.get('remote_ip_prefix'),
+                              remote_group_id=rule.get('remote_group_id'),
+                              direction=rule.get('direction', 'ingress'))
+
+
 class LibcloudClient(object):
 
     def get(self, mapper, config, *args, **kw):
@@ -85,14 +156,44 @@ class LibcloudClient(object):
         return ret
 
     def connect(self, cfg, mapper):
-        self.driver = mapper.connect(cfg)
+        self.config = cfg
+        self.mapper = mapper
+        # Metrics wrap the raw requests, so every throttled attempt counts
+        self.driver = rate_limiter.instrument(
+            api_metrics.instrument(mapper.connect(cfg)), cfg)
         return self
 
+    def run_concurrently(self, *tasks):
+        # Calls every task with a client of its own, as drivers are not
+        # shared between threads, and returns their results in order
+        def with_own_client(task):
+            return lambda: task(type(self)().get(mapper=self.mapper,
+                                                 config=self.config))
+        return run_concurrently([with_own_client(task) for task in tasks])
+
+    def regions(self):
+        # cloud_provider_name first, then the other regions of the
+        # multi-region mode
+        regions = [self.config['cloud_provider_name']]
+        for region in self.config.get('regions', []):
+            if region not in regions:
+                regions.append(region)
+        return regions
+
+    def for_region(self, region):
+        mapper = Mapper(transfer_cloud_provider_name(region))
+        return type(self)().get(mapper=mapper, config=self.config)
+
 
 class LibcloudServerClient(LibcloudClient):
 
     @abc.abstractmethod
-    def create(self, name, ctx, server_context, provider_context):
+    def create(self, name, ctx, server_context, provider_context,
+               launch_parameters=None):
+        return
+
+    @abc.abstractmethod
+    def resolve_launch_parameters(self, server_context):
         return
 
     @abc.abstractmethod
@@ -103,6 +204,34 @@ class LibcloudServerClient(LibcloudClient):
     def get_by_name(self, server_name):
         return
 
+    @abc.abstractmethod
+    def get_by_instance(self, deployment_id, instance_id):
+        return
+
+    @abc.abstractmethod
+    def get_inventory(self, deployment_id):
+        return
+
+    def get_inventories(self, deployment_id):
+        # Queries every region at once and returns (region, inventory)
+        # pairs. The inventory of a region that failed is None. Response
+        # times are recorded for placement.
+        def inventory(region):
+            def task():
+                start = time.time()
+                try:
+                    result = self.for_region(region).get_inventory(
+                        deployment_id)
+                except Exception:
+                    return None
+                region_stats.record_latency(region, time.time() - start)
+                return result
+            return task
+        regions = self.regions()
+        return zip(regions,
+                   run_concurrently([inventory(region)
+                                     for region in regions]))
+
     @abc.abstractmethod
     def start_server(self, server):
         return
@@ -112,15 +241,19 @@ class LibcloudServerClient(LibcloudClient):
         return
 
     @abc.abstractmethod
-    def delete_server(self, server):
+    def delete_server(self, server, batch=False):
+        return
+
+    @abc.abstractmethod
+    def wait_for_server_to_be_deleted(self, server, wait):
         return
 
     @abc.abstractmethod
-    def wait_for_server_to_be_deleted(self, server, timeout, sleep_time):
+    def wait_for_server_to_be_running(self, server, wait):
         return
 
     @abc.abstractmethod
-    def wait_for_server_to_be_running(self, server, timeout, sleep_time):
+    def is_server_terminated(self, server_id):
         return
 
     @abc.abstractmethod
@@ -132,13 +265,17 @@ class LibcloudServerClient(LibcloudClient):
         return
 
     @abc.abstractmethod
-    def get_image_by_name(self, image_name):
+    def get_image_by_name(self, image_name, owner=None, filters=None):
         return
 
     @abc.abstractmethod
     def get_size_by_name(self, size_name):
         return
 
+    @abc.abstractmethod
+    def refresh_size_catalog(self):
+        return
+
     @abc.abstractmethod
     def is_server_active(self, server):
         return
@@ -173,6 +310,10 @@ class LibcloudSecurityGroupClient(LibcloudClient):
     def get_list_by_name(self, name):
         return
 
+    @abc.abstractmethod
+    def get_lists_by_names(self, names):
+        return
+
     @abc.abstractmethod
     def get_description(self, sg):
         return
@@ -189,6 +330,14 @@ class LibcloudSecurityGroupClient(LibcloudClient):
     def create_security_group_rule(self, rule):
         return
 
+    @abc.abstractmethod
+    def create_security_group_rules(self, security_group_id, rules):
+        return
+
+    @abc.abstractmethod
+    def revoke_security_group_rules(self, security_group_id, rules):
+        return
+
 
 # Decorators
 def _find_instanceof_in_kw(cls, kw):
@@ -203,39 +352,80 @@ def _find_instanceof_in_kw(cls, kw):
 
 
 def _find_context_in_kw(kw):
+    from cloudify import context
     return _find_instanceof_in_kw(context.CloudifyContext, kw)
 
 
+CONNECTION_CONFIG_CACHE_MAX_SIZE = 128
+
+_connection_config_cache = {}
+_connection_config_lock = threading.Lock()
+
+
+def _get_static_connection_config():
+    # Returns the parsed config file along with a (path, mtime, size)
+    # signature. The file is only re-read when the signature changes.
+    which = 'connection'
+    env_name = which.upper() + '_CONFIG_PATH'
+    default_location_tpl = '~/' + which + '_config.json'
+    default_location = os.path.expanduser(default_location_tpl)
+    config_path = os.getenv(env_name, default_location)
+    try:
+        stat = os.stat(config_path)
+        signature = (config_path, stat.st_mtime, stat.st_size)
+        with _connection_config_lock:
+            cached = _connection_config_cache.get(config_path)
+        if cached is not None and cached[0] == signature:
+            return cached
+        with open(config_path) as f:
+            cfg = json.loads(f.read())
+    except (IOError, OSError):
+        raise NonRecoverableError(
+            "Failed to read {0} configuration from file '{1}'."
+            "The configuration is looked up in {2}. If defined, "
+            "environment variable "
+            "{3} overrides that location.".format(
+                which, config_path, default_location_tpl, env_name))
+    with _connection_config_lock:
+        _connection_config_cache[config_path] = (signature, cfg)
+    return signature, cfg
+
+
+def _merge_connection_config(signature, static_config, config):
+    if not config:
+        return dict(static_config)
+    key = (signature, json.dumps(config, sort_keys=True))
+    with _connection_config_lock:
+        merged = _connection_config_cache.get(key)
+        if merged is None:
+            if len(_connection_config_cache) > \
+                    CONNECTION_CONFIG_CACHE_MAX_SIZE:
+                _connection_config_cache.clear()
+            merged = dict(static_config)
+            merged.update(config)
+            _connection_config_cache[key] = merged
+    return dict(merged)
+
+
 def _get_connection_config(ctx):
-    def _get_static_config():
-        which = 'connection'
-        env_name = which.upper() + '_CONFIG_PATH'
-        default_location_tpl = '~/' + which + '_config.json'
-        default_location = os.path.expanduser(default_location_tpl)
-        config_path = os.getenv(env_name, default_location)
-        try:
-            with open(config_path) as f:
-                cfg = json.loads(f.read())
-        except IOError:
-            raise NonRecoverableError(
-                "Failed to read {0} configuration from file '{1}'."
-                "The configuration is looked up in {2}. If defined, "
-                "environment variable "
-                "{3} overrides that location.".format(
-                    which, config_path, default_location_tpl, env_name))
-        return cfg
-    static_config = _get_static_config()
-    cfg = {}
-    cfg.update(static_config)
+    from cloudify import context
+    signature, static_config = _get_static_connection_config()
     if ctx.type == context.NODE_INSTANCE:
         config = ctx.node.properties.get('connection_config')
     else:
         config = ctx.source.node.properties.get('connection_config')
         if config is None:
             config = ctx.target.node.properties.get('connection_config')
-    if config:
-        cfg.update(config)
-    return cfg
+    return _merge_connection_config(signature, static_config, config)
+
+
+def _get_server_region(ctx):
+    from cloudify import context
+    if ctx.type == context.NODE_INSTANCE:
+        instance = ctx.instance
+    else:
+        instance = ctx.source.instance
+    return instance.runtime_properties.get(LIBCLOUD_REGION_PROPERTY)
 
 
 def with_server_client(f):
@@ -243,10 +433,12 @@ def with_server_client(f):
     def wrapper(*args, **kw):
         ctx = _find_context_in_kw(kw)
         config = _get_connection_config(ctx)
-        mapper = Mapper(
-            transfer_cloud_provider_name(config['cloud_provider_name']))
+        # Servers placed in another region are managed there
+        mapper = Mapper(transfer_cloud_provider_name(
+            _get_server_region(ctx) or config['cloud_provider_name']))
         kw['server_client'] = mapper.get_server_client(config)
-        return f(*args, **kw)
+        with api_metrics.operation(ctx.task_name, config):
+            return f(*args, **kw)
     return wrapper
 
 
@@ -258,7 +450,8 @@ def with_floating_ip_client(f):
         mapper = Mapper(
             transfer_cloud_provider_name(config['cloud_provider_name']))
         kw['floating_ip_client'] = mapper.get_floating_ip_client(config)
-        return f(*args, **kw)
+        with api_metrics.operation(ctx.task_name, config):
+            return f(*args, **kw)
     return wrapper
 
 
@@ -277,7 +470,8 @@ def with_security_group_client(f):
         mapper = Mapper(
             transfer_cloud_provider_name(config['cloud_provider_name']))
         kw['security_group_client'] = mapper.get_security_group_client(config)
-        return f(*args, **kw)
+        with api_metrics.operation(ctx.task_name, config):
+            return f(*args, **kw)
     return wrapper
 
 
@@ -296,65 +490,271 @@ def _re_raise(e, recoverable, retry_after=None):
         raise NonRecoverableError(e.message), None, traceback
 
 
+DRIVER_POOL_MAX_SIZE = 32
+DRIVER_POOL_IDLE_TIMEOUT = 300
+DRIVER_KEEP_ALIVE_TIMEOUT = 15
+RECONNECT_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+def _is_idempotent_request(params):
+    # A request the server may have processed before closing the
+    # connection can only be sent again if that has no further effect
+    params = params or {}
+    return str(params.get('Action', '')).startswith('Describe') or \
+        'ClientToken' in params
+
+
+class DriverPool(object):
+
+    def __init__(self,
+                 max_size=DRIVER_POOL_MAX_SIZE,
+                 idle_timeout=DRIVER_POOL_IDLE_TIMEOUT,
+                 keep_alive_timeout=DRIVER_KEEP_ALIVE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self._drivers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, provider, access_id, secret_key, **driver_kwargs):
+        # libcloud connections keep per-request state, so a driver is
+        # never shared between threads.
+        key = (threading.current_thread().ident,
+               provider,
+               access_id,
+               hashlib.sha1(secret_key.encode('utf-8')).hexdigest(),
+               tuple(sorted(driver_kwargs.items())))
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._drivers.pop(key, None)
+            if entry is None:
+                # Imported on first use, it is the slowest part of libcloud
+                # to load
+                from libcloud.compute.providers import get_driver
+                driver = get_driver(provider)(access_id, secret_key,
+                                              **driver_kwargs)
+                self._keep_alive(driver)
+            else:
+                driver = entry[0]
+            self._drivers[key] = (driver, now)
+            while len(self._drivers) > self.max_size:
+                self._drivers.popitem(last=False)
+        return driver
+
+    def clear(self):
+        with self._lock:
+            self._drivers.clear()
+
+    def _evict_idle(self, now):
+        for key, (_, last_used) in self._drivers.items():
+            if now - last_used <= self.idle_timeout:
+                # Entries are kept in least recently used order
+                break
+            del self._drivers[key]
+
+    def _keep_alive(self, driver):
+        # libcloud opens a new HTTP(S) connection for every request.
+        # Reuse the previous one while it is fresh to skip the handshake.
+        connection = driver.connection
+        connect = connection.connect
+        request = connection.request
+        last_used = [0]
+        reused = [False]
+        timeout = self.keep_alive_timeout
+
+        def connect_or_reuse(host=None, port=None, base_url=None):
+            now = time.time()
+            reused[0] = not (connection.connection is None or
+                             host or port or base_url or
+                             now - last_used[0] > timeout)
+            if not reused[0]:
+                connect(host=host, port=port, base_url=base_url)
+            last_used[0] = now
+
+        def request_or_reconnect(action, params=None, *args, **kwargs):
+            try:
+                return request(action, params, *args, **kwargs)
+            except (httplib.BadStatusLine, socket.error) as e:
+                # The next request connects again in any case
+                last_used[0] = 0
+                if not reused[0] or \
+                        not _is_idempotent_request(params) or \
+                        (isinstance(e, socket.error) and
+                         e.errno not in RECONNECT_ERRNOS):
+                    raise
+            # The server most likely closed the idle connection before
+            # reading the request; send it again on a new one
+            return request(action, params, *args, **kwargs)
+
+        connection.connect = connect_or_reuse
+        connection.request = request_or_reconnect
+
+
+_driver_pool = DriverPool()
+
+
+CONCURRENT_MAX_WORKERS = 4
+
+_concurrent_pool = None
+_concurrent_pool_pid = None
+_concurrent_pool_lock = threading.Lock()
+
+
+def _get_concurrent_pool():
+    # Long-lived threads, so the drivers pooled for them keep their
+    # connections. Created on first use, and again after a fork.
+    global _concurrent_pool, _concurrent_pool_pid
+    with _concurrent_pool_lock:
+        if _concurrent_pool is None or _concurrent_pool_pid != os.getpid():
+            from multiprocessing.pool import ThreadPool
+            _concurrent_pool = ThreadPool(CONCURRENT_MAX_WORKERS)
+            _concurrent_pool_pid = os.getpid()
+        return _concurrent_pool
+
+
+def run_concurrently(tasks):
+    # Runs the callables on a bounded thread pool and returns their
+    # results in order. The first error is raised as soon as it happens;
+    # tasks that have not started by then are skipped.
+    results = Queue.Queue()
+    failed = threading.Event()
+    operation = api_metrics.current_operation() or ('unknown', {})
+
+    def run(index, task):
+        if failed.is_set():
+            return
+        try:
+            with api_metrics.continued(operation):
+                results.put((index, True, task()))
+        except Exception:
+            failed.set()
+            results.put((index, False, sys.exc_info()))
+
+    pool = _get_concurrent_pool()
+    for index, task in enumerate(tasks):
+        pool.apply_async(run, (index, task))
+    values = [None] * len(tasks)
+    for _ in tasks:
+        index, succeeded, value = results.get()
+        if not succeeded:
+            raise value[0], value[1], value[2]
+        values[index] = value
+    return values
+
+
+WAIT_MAX_SLEEP_TIME = 30
+WAIT_BACKOFF_FACTOR = 2
+WAIT_JITTER = 0.2
+
+
+class WaitStrategy(object):
+
+    def __init__(self,
+                 timeout,
+                 sleep_time,
+                 max_sleep_time=WAIT_MAX_SLEEP_TIME,
+                 blocking=True,
+                 deadline=None,
+                 attempt=0):
+        self.timeout = timeout
+        self.sleep_time = sleep_time
+        self.max_sleep_time = max_sleep_time
+        self.blocking = blocking
+        # Wall clock rather than a monotonic one: a non-blocking wait is
+        # resumed from runtime properties, possibly in another process.
+        self.deadline = deadline if deadline is not None \
+            else time.time() + timeout
+        self.attempt = attempt
+
+    def remaining(self):
+        return max(0, self.deadline - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def next_delay(self):
+        delay = min(self.max_sleep_time,
+                    self.sleep_time * WAIT_BACKOFF_FACTOR ** self.attempt)
+        delay *= random.uniform(1 - WAIT_JITTER, 1 + WAIT_JITTER)
+        self.attempt += 1
+        return min(delay, self.remaining())
+
+    def sleep(self, message):
+        delay = self.next_delay()
+        if not self.blocking:
+            raise RecoverableError(message=message,
+                                   retry_after=int(math.ceil(delay)) or 1)
+        time.sleep(delay)
+
+    def to_dict(self):
+        return {'deadline': self.deadline, 'attempt': self.attempt}
+
+
+# libcloud's Provider constants, literal so that loading the plugin does
+# not import libcloud. Provider.EC2 is the EC2 driver of any region.
+EC2 = 'ec2_us_east'
+
+# Provider name -> (core provider, libcloud provider)
+PROVIDERS = {
+    'ec2_ap_northeast': (EC2, 'ec2_ap_northeast'),
+    'ec2_ap_southeast': (EC2, 'ec2_ap_southeast'),
+    'ec2_ap_southeast_2': (EC2, 'ec2_ap_southeast_2'),
+    'ec2_eu_west': (EC2, 'ec2_eu_west'),
+    'ec2_sa_east': (EC2, 'ec2_sa_east'),
+    'ec2_us_east': (EC2, 'ec2_us_east'),
+    'ec2_us_west': (EC2, 'ec2_us_west'),
+    'ec2_us_west_oregon': (EC2, 'ec2_us_west_oregon'),
+}
+
+
 class Mapper(object):
 
     def __init__(self, provider_name):
-        if provider_name == Provider.EC2_AP_NORTHEAST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_AP_NORTHEAST
-        elif provider_name == Provider.EC2_AP_SOUTHEAST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_AP_SOUTHEAST
-        elif provider_name == Provider.EC2_AP_SOUTHEAST2:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_AP_SOUTHEAST2
-        elif provider_name == Provider.EC2_EU:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_EU
-        elif provider_name == Provider.EC2_EU_WEST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_EU_WEST
-        elif provider_name == Provider.EC2_SA_EAST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_SA_EAST
-        elif provider_name == Provider.EC2_US_EAST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_US_EAST
-        elif provider_name == Provider.EC2_US_WEST:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_US_WEST
-        elif provider_name == Provider.EC2_US_WEST_OREGON:
-            self.core_provider = Provider.EC2
-            self.provider = Provider.EC2_US_WEST_OREGON
-        else:
+        try:
+            self.core_provider, self.provider = PROVIDERS[provider_name]
+        except KeyError:
             raise NonRecoverableError('Error during trying to choose'
                                       ' the Libcloud provider,'
                                       ' provider name: {0}'
                                       .format(provider_name))
 
     def connect(self, connection_config):
-        if self.core_provider == Provider.EC2:
-            return get_driver(self.provider)(connection_config['access_id'],
-                                             connection_config['secret_key'])
+        # endpoint_* keys point the driver at an EC2-compatible endpoint
+        # other than the region's own, e.g. a local stand-in
+        driver_kwargs = {}
+        if connection_config.get('endpoint_host'):
+            driver_kwargs['host'] = connection_config['endpoint_host']
+            if connection_config.get('endpoint_port'):
+                driver_kwargs['port'] = int(
+                    connection_config['endpoint_port'])
+        if 'endpoint_secure' in connection_config:
+            driver_kwargs['secure'] = bool(
+                connection_config['endpoint_secure'])
+        if self.core_provider == EC2:
+            return _driver_pool.get(self.provider,
+                                    connection_config['access_id'],
+                                    connection_config['secret_key'],
+                                    **driver_kwargs)
 
     def get_server_client(self, config):
-        if self.core_provider == Provider.EC2:
+        if self.core_provider == EC2:
             from ec2 import EC2LibcloudServerClient
             return EC2LibcloudServerClient().get(mapper=self, config=config)
 
     def get_floating_ip_client(self, config):
-        if self.core_provider == Provider.EC2:
+        if self.core_provider == EC2:
             from ec2 import EC2LibcloudFloatingIPClient
             return EC2LibcloudFloatingIPClient()\
                 .get(mapper=self, config=config)
 
     def get_security_group_client(self, config):
-        if self.core_provider == Provider.EC2:
+        if self.core_provider == EC2:
             from ec2 import EC2LibcloudSecurityGroupClient
             return EC2LibcloudSecurityGroupClient()\
                 .get(mapper=self, config=config)
 
     def get_provider_context(self, context):
-        if self.core_provider == Provider.EC2:
+        if self.core_provider == EC2:
             from ec2 import EC2LibcloudProviderContext
             return EC2LibcloudProviderContext(context)
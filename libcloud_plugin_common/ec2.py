@@ -14,23 +14,602 @@
 #  * limitations under the License.
 
 
+import collections
+import errno
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
 import time
-from cloudify.exceptions import NonRecoverableError
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 from libcloud.compute.types import NodeState
 from libcloud_plugin_common import (LibcloudServerClient,
                                     LibcloudFloatingIPClient,
                                     LibcloudSecurityGroupClient,
                                     transform_resource_name,
-                                    LibcloudProviderContext)
+                                    LibcloudProviderContext,
+                                    SecurityGroupRule)
+
+
+# Identity of the node instance a server was launched for
+DEPLOYMENT_ID_TAG = 'cloudify_deployment_id'
+NODE_ID_TAG = 'cloudify_node_id'
+NODE_INSTANCE_ID_TAG = 'cloudify_node_instance_id'
+# Keeps the query string of a GET request short
+INSTANCE_ID_FILTER_BATCH = 100
+
+
+def _driver_key(driver):
+    return driver.key, driver.region_name
+
+
+def _describe_instances(driver, filters):
+    # DescribeInstances without list_nodes()' address mapping
+    params = {'Action': 'DescribeInstances'}
+    params.update(driver._build_filters(filters))
+    response = driver.connection.request(driver.path, params=params).object
+    return driver._to_nodes(response,
+                            'reservationSet/item/instancesSet/item')
+
+
+def _describe_instances_by_id(driver, node_ids):
+    nodes = []
+    for i in range(0, len(node_ids), INSTANCE_ID_FILTER_BATCH):
+        nodes.extend(_describe_instances(
+            driver,
+            {'instance-id': node_ids[i:i + INSTANCE_ID_FILTER_BATCH]}))
+    return nodes
+
+
+class NodeStatePoller(object):
+    # One DescribeInstances call per tick is shared by all waiters: the
+    # first waiter of a tick polls every registered instance id on behalf
+    # of the others. An instance-id filter is used instead of a list of
+    # ids, so an instance that is not visible yet does not fail the batch.
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiters = {}
+        self._nodes = {}
+        self._tick = 0
+        self._polling = False
+
+    def poll(self, driver, node_id):
+        with self._condition:
+            self._waiters[node_id] = self._waiters.get(node_id, 0) + 1
+            # A poll that is already running does not include this id
+            tick = self._tick + (2 if self._polling else 1)
+            try:
+                while self._tick < tick:
+                    if self._polling:
+                        self._condition.wait()
+                        continue
+                    self._polling = True
+                    node_ids = list(self._waiters)
+                    self._condition.release()
+                    try:
+                        # Addresses are not needed; list_nodes() would
+                        # describe every address of the account
+                        nodes = _describe_instances_by_id(driver,
+                                                          node_ids)
+                    finally:
+                        self._condition.acquire()
+                        self._polling = False
+                        self._condition.notify_all()
+                    self._nodes = dict((node.id, node) for node in nodes)
+                    self._tick += 1
+                return self._nodes.get(node_id)
+            finally:
+                self._waiters[node_id] -= 1
+                if not self._waiters[node_id]:
+                    del self._waiters[node_id]
+
+
+_state_pollers = {}
+_state_pollers_lock = threading.Lock()
+
+
+def _state_poller(driver):
+    with _state_pollers_lock:
+        return _state_pollers.setdefault(_driver_key(driver),
+                                         NodeStatePoller())
+
+
+TERMINATION_CHECK_TTL = 2
+TERMINATION_PENDING_TTL = 10 * 60
+
+
+class TerminationTracker(object):
+    # Instances whose termination was issued without waiting for it. They
+    # are checked together: a single DescribeInstances call covers every
+    # pending instance of a region and answers the checks made within
+    # TERMINATION_CHECK_TTL of it. Addresses are not needed, so the call
+    # skips list_nodes() and its DescribeAddresses.
+
+    def __init__(self,
+                 check_ttl=TERMINATION_CHECK_TTL,
+                 pending_ttl=TERMINATION_PENDING_TTL):
+        self.check_ttl = check_ttl
+        self.pending_ttl = pending_ttl
+        self._regions = {}
+        self._lock = threading.Lock()
+
+    def is_terminated(self, driver, node_id):
+        with self._lock:
+            region = self._regions.setdefault(_driver_key(driver), {
+                'lock': threading.Lock(),
+                'pending': {},
+                'checked': 0,
+                'alive': set(),
+            })
+        # Checks of other regions do not wait for this one's
+        with region['lock']:
+            now = time.time()
+            pending = region['pending']
+            if node_id not in pending or \
+                    now - region['checked'] > self.check_ttl:
+                pending[node_id] = now
+                self._check(driver, region, now)
+            pending[node_id] = now
+            if node_id in region['alive']:
+                return False
+            del pending[node_id]
+            return True
+
+    def _check(self, driver, region, now):
+        # Instances nobody asked about for a while were given up on
+        for node_id, asked in region['pending'].items():
+            if now - asked > self.pending_ttl:
+                del region['pending'][node_id]
+        node_ids = list(region['pending'])
+        nodes = _describe_instances_by_id(driver, node_ids)
+        # Instances that are no longer listed count as terminated
+        region['alive'] = set(node.id for node in nodes
+                              if node.state != NodeState.TERMINATED)
+        region['checked'] = now
+
+
+_termination_tracker = TerminationTracker()
+
+
+SIZE_CATALOG_TTL = 24 * 60 * 60
+
+
+class SizeCatalog(object):
+    # libcloud builds the EC2 size list from its bundled tables and
+    # pricing data on every call; keep it indexed by id per region.
+
+    def __init__(self):
+        self._catalogs = {}
+        self._lock = threading.Lock()
+
+    def get(self, driver, size_id, ttl=SIZE_CATALOG_TTL):
+        with self._lock:
+            catalog = self._catalogs.get(driver.region_name)
+        if catalog is None or time.time() - catalog['loaded'] > ttl:
+            catalog = self.refresh(driver)
+        return catalog['sizes'].get(size_id)
+
+    def refresh(self, driver):
+        catalog = {
+            'loaded': time.time(),
+            'sizes': dict((size.id, size) for size in driver.list_sizes()),
+        }
+        with self._lock:
+            self._catalogs[driver.region_name] = catalog
+        return catalog
+
+
+_size_catalog = SizeCatalog()
+
+
+IMAGE_CACHE_TTL = 10 * 60
+IMAGE_CACHE_MAX_SIZE = 256
+
+
+class ImageResolver(object):
+    # Resolves an AMI id, name or name wildcard (plus optional owner and
+    # extra DescribeImages filters) and caches the result per query.
+
+    def __init__(self, ttl=IMAGE_CACHE_TTL, max_size=IMAGE_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, driver, image_name, owner=None, filters=None):
+        key = (_driver_key(driver),
+               image_name,
+               owner,
+               json.dumps(filters, sort_keys=True))
+        now = time.time()
+        with self._lock:
+            entry = self._images.pop(key, None)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._images[key] = entry
+                return entry[0]
+        image = self._describe(driver, image_name, owner, filters)
+        if image is not None:
+            with self._lock:
+                self._images[key] = (image, now)
+                while len(self._images) > self.max_size:
+                    self._images.popitem(last=False)
+        return image
+
+    def _describe(self, driver, image_name, owner, filters):
+        # list_images() in libcloud 0.15 takes no filters, so the request
+        # is built here.
+        params = {'Action': 'DescribeImages'}
+        query = {}
+        if image_name.startswith('ami-'):
+            params['ImageId.1'] = image_name
+            if owner:
+                params['Owner.1'] = owner
+        else:
+            # Anyone can publish a public image with a matching name, so
+            # names only match the account's own images unless an owner is
+            # given
+            params['Owner.1'] = owner or 'self'
+            query['name'] = image_name
+            query['state'] = 'available'
+        query.update(filters or {})
+        if query:
+            params.update(driver._build_filters(query))
+        images = driver._to_images(
+            driver.connection.request(driver.path, params=params).object)
+        if not images:
+            return None
+        # Wildcards may match several images; image names usually carry a
+        # version or date, so the last one by name is taken.
+        return max(images, key=lambda image: image.name or '')
+
+
+_image_resolver = ImageResolver()
+
+
+ADDRESS_CACHE_TTL = 5 * 60
+
+
+class AddressCache(object):
+
+    def __init__(self, ttl=ADDRESS_CACHE_TTL):
+        self.ttl = ttl
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+    def get(self, driver, ip):
+        with self._lock:
+            entry = self._addresses.get((_driver_key(driver), ip))
+        if entry is not None and time.time() - entry[1] <= self.ttl:
+            return entry[0]
+
+    def put(self, driver, address):
+        with self._lock:
+            self._addresses[(_driver_key(driver), address.ip)] = \
+                (address, time.time())
+
+    def discard(self, driver, ip):
+        with self._lock:
+            self._addresses.pop((_driver_key(driver), ip), None)
+
+
+_address_cache = AddressCache()
+
+
+class CoalescingBatcher(object):
+    # Calls made with the same key within a short window are served by a
+    # single call for all of their items. The first caller of a batch waits
+    # for the window to pass (or the batch to fill up) and makes the call;
+    # every caller then gets the result for its own item. A result that is
+    # an exception is raised to its caller only.
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._condition = threading.Condition()
+        self._batches = {}
+
+    def _submit(self, key, item, execute):
+        with self._condition:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = {'items': [], 'results': None, 'error': None,
+                         'done': False}
+                self._batches[key] = batch
+            batch['items'].append(item)
+            if len(batch['items']) >= self.max_batch:
+                self._batches.pop(key, None)
+                self._condition.notify_all()
+
+            if leader:
+                deadline = time.time() + self.window
+                while self._batches.get(key) is batch and \
+                        time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+                items = list(batch['items'])
+                self._condition.release()
+                try:
+                    batch['results'] = execute(items)
+                except Exception as e:
+                    batch['error'] = e
+                finally:
+                    self._condition.acquire()
+                batch['done'] = True
+                self._condition.notify_all()
+            else:
+                while not batch['done']:
+                    self._condition.wait()
+
+            if batch['error'] is not None:
+                raise batch['error']
+            result = batch['results'][item]
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+
+PROVISIONING_WINDOW = 2
+PROVISIONING_MAX_BATCH = 50
+
+
+class ProvisioningBatcher(CoalescingBatcher):
+    # Coalesces create_node calls with the same launch key into one
+    # RunInstances call; every caller gets the node launched for its name.
+
+    def __init__(self,
+                 window=PROVISIONING_WINDOW,
+                 max_batch=PROVISIONING_MAX_BATCH):
+        super(ProvisioningBatcher, self).__init__(window, max_batch)
+
+    def create_node(self, driver, launch_key, name, tags, **kwargs):
+        return self._submit((_driver_key(driver), launch_key),
+                            (name, tuple(sorted(tags.items()))),
+                            lambda items: self._launch(driver, items, kwargs))
+
+    def _launch(self, driver, items, kwargs):
+        # libcloud tags every instance of a reservation like the first one,
+        # so only the tags shared by the batch go to RunInstances
+        name, tags = items[0]
+        nodes = driver.create_node(name=name,
+                                   ex_metadata=dict(
+                                       (key, value) for key, value in tags
+                                       if key != NODE_INSTANCE_ID_TAG),
+                                   ex_mincount=len(items),
+                                   ex_maxcount=len(items),
+                                   **kwargs)
+        if not isinstance(nodes, list):
+            nodes = [nodes]
+        # Every instance is running by now; a tagging error goes to its own
+        # caller only, along with the instance
+        results = {}
+        for item, node in zip(items, nodes):
+            name, tags = item
+            tags = {'Name': name,
+                    NODE_INSTANCE_ID_TAG: dict(tags)[NODE_INSTANCE_ID_TAG]}
+            try:
+                driver.ex_create_tags(node, tags)
+            except Exception as e:
+                results[item] = UntaggedNodeError(node, e)
+                continue
+            node.name = name
+            node.extra.setdefault('tags', {}).update(tags)
+            results[item] = node
+        return results
+
+
+class UntaggedNodeError(RecoverableError):
+    # A launched instance its node instance could not be tagged on
+
+    def __init__(self, node, error):
+        super(UntaggedNodeError, self).__init__(
+            message='Failed to tag server {0}: {1}'.format(node.id, error),
+            retry_after=getattr(error, 'retry_after', None))
+        self.node = node
+
+
+_provisioning_batcher = ProvisioningBatcher()
+
+
+TERMINATION_WINDOW = 2
+# Also keeps the query string of a GET request short
+TERMINATION_MAX_BATCH = 100
+
+
+class TerminationBatcher(CoalescingBatcher):
+    # Coalesces the terminations of a region into TerminateInstances calls
+    # of up to TERMINATION_MAX_BATCH instances each.
+
+    def __init__(self,
+                 window=TERMINATION_WINDOW,
+                 max_batch=TERMINATION_MAX_BATCH):
+        super(TerminationBatcher, self).__init__(window, max_batch)
+
+    def destroy_node(self, driver, node_id):
+        return self._submit(_driver_key(driver),
+                            node_id,
+                            lambda node_ids: self._terminate(driver,
+                                                             node_ids))
+
+    def _terminate(self, driver, node_ids):
+        params = {'Action': 'TerminateInstances'}
+        for i, node_id in enumerate(node_ids):
+            params['InstanceId.{0}'.format(i + 1)] = node_id
+        try:
+            driver.connection.request(driver.path, params=params)
+        except Exception as e:
+            if len(node_ids) == 1 or 'InvalidInstanceID' not in str(e):
+                raise
+            # One unknown instance fails the whole call; terminate one by
+            # one so that only its own caller gets the error
+            results = {}
+            for node_id in node_ids:
+                try:
+                    results[node_id] = self._terminate(driver,
+                                                       [node_id])[node_id]
+                except Exception as error:
+                    results[node_id] = error
+            return results
+        return dict((node_id, True) for node_id in node_ids)
+
+
+_termination_batcher = TerminationBatcher()
+
+
+LAUNCH_JOURNAL_DIR = os.path.join(tempfile.gettempdir(),
+                                  'cloudify-libcloud-launches')
+LAUNCH_JOURNAL_TTL = 24 * 60 * 60
+LAUNCH_JOURNAL_PRUNE_INTERVAL = 60 * 60
+# States of instances a lookup by node instance may return
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+_journal_pruned = {}
+
+
+def _client_token(ctx):
+    # Retries of a task share the execution; a later install does not
+    return hashlib.sha1('{0}:{1}:{2}'.format(
+        ctx.deployment.id, ctx.instance.id, ctx.execution_id)).hexdigest()
+
+
+class LaunchJournal(object):
+    # Servers launched from this host, one file per node instance. An entry
+    # is written with the client token before RunInstances and completed
+    # with the instance id after it, so a retried start finds the instance
+    # with one direct lookup, even if it failed before libcloud_server_id
+    # was stored or before the instance was tagged.
+    #
+    # Connection config key:
+    #   launch_journal_dir - directory of the journal entries
+
+    def __init__(self, directory=LAUNCH_JOURNAL_DIR, ttl=LAUNCH_JOURNAL_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def get(self, driver, deployment_id, instance_id):
+        try:
+            with open(self._path(driver, deployment_id, instance_id)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry['launched_at'] > self.ttl:
+            return None
+        return entry
+
+    def begin(self, driver, deployment_id, instance_id, client_token):
+        self._write(driver, deployment_id, instance_id, client_token, None)
+
+    def complete(self, driver, deployment_id, instance_id, client_token,
+                 server_id):
+        self._write(driver, deployment_id, instance_id, client_token,
+                    server_id)
+
+    def _write(self, driver, deployment_id, instance_id, client_token,
+               server_id):
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._prune()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'client_token': client_token,
+                       'server_id': server_id,
+                       'launched_at': time.time()}, f)
+        # Readers see either the previous entry or this one
+        os.rename(temp_path,
+                  self._path(driver, deployment_id, instance_id))
+
+    def _prune(self):
+        now = time.time()
+        if now - _journal_pruned.get(self.directory, 0) < \
+                LAUNCH_JOURNAL_PRUNE_INTERVAL:
+            return
+        _journal_pruned[self.directory] = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                # Removed by another worker
+                pass
+
+    def _path(self, driver, deployment_id, instance_id):
+        return os.path.join(self.directory, hashlib.sha1(
+            '{0}:{1}:{2}:{3}'.format(driver.key, driver.region_name,
+                                     deployment_id,
+                                     instance_id)).hexdigest() + '.json')
 
 
 class EC2LibcloudServerClient(LibcloudServerClient):
 
     def get_by_name(self, server_name):
-        nodes = self.driver.list_nodes()
-        for node in nodes:
-            if node.name == server_name:
+        return self._find_live_node({'tag:Name': server_name})
+
+    def get_by_instance(self, deployment_id, instance_id):
+        entry = self._launch_journal().get(self.driver,
+                                           deployment_id,
+                                           instance_id)
+        if entry is not None:
+            if entry['server_id'] is not None:
+                node = self._find_live_node(
+                    {'instance-id': entry['server_id']})
+            elif entry['client_token'] is not None:
+                node = self._find_live_node(
+                    {'client-token': entry['client_token']})
+            else:
+                node = None
+            if node is not None:
+                # The launch may have failed before tagging the instance
+                if NODE_INSTANCE_ID_TAG not in node.extra['tags']:
+                    self.driver.ex_create_tags(node, {
+                        'Name': instance_id,
+                        DEPLOYMENT_ID_TAG: deployment_id,
+                        NODE_INSTANCE_ID_TAG: instance_id,
+                    })
                 return node
+        return self._find_live_node({
+            'tag:' + DEPLOYMENT_ID_TAG: deployment_id,
+            'tag:' + NODE_INSTANCE_ID_TAG: instance_id,
+        })
+
+    def get_inventory(self, deployment_id):
+        # Live servers of the deployment by node instance id, and the
+        # number of them per node
+        inventory = {'servers': {}, 'placed': collections.Counter()}
+        for node in _describe_instances(self.driver, {
+                'tag:' + DEPLOYMENT_ID_TAG: deployment_id,
+                'instance-state-name': LIVE_INSTANCE_STATES}):
+            tags = node.extra['tags']
+            if NODE_INSTANCE_ID_TAG in tags:
+                inventory['servers'][tags[NODE_INSTANCE_ID_TAG]] = node
+            if NODE_ID_TAG in tags:
+                inventory['placed'][tags[NODE_ID_TAG]] += 1
+        return inventory
+
+    def _find_live_node(self, filters):
+        # Filtered server side. list_nodes() is not used: it would describe
+        # every address of the account when nothing matches. Terminated
+        # instances of an earlier install are left out.
+        filters = dict(filters, **{
+            'instance-state-name': LIVE_INSTANCE_STATES})
+        nodes = _describe_instances(self.driver, filters)
+        if not nodes:
+            return None
+        node = nodes[0]
+        node.public_ips.extend(
+            self.driver.ex_describe_addresses([node])[node.id])
+        return node
+
+    def _launch_journal(self):
+        return LaunchJournal(self.config.get('launch_journal_dir',
+                                             LAUNCH_JOURNAL_DIR))
 
     def get_by_id(self, server_id):
         nodes = self.driver.list_nodes(ex_node_ids=[server_id])
@@ -42,34 +621,36 @@ class EC2LibcloudServerClient(LibcloudServerClient):
     def stop_server(self, server):
         self.driver.ex_stop_node(server)
 
-    def delete_server(self, server):
-        self.driver.destroy_node(server)
+    def delete_server(self, server, batch=False):
+        if batch:
+            _termination_batcher.destroy_node(self.driver, server.id)
+        else:
+            self.driver.destroy_node(server)
 
-    def wait_for_server_to_be_deleted(self, server, timeout, sleep_time):
+    def wait_for_server_to_be_deleted(self, server, wait):
         self._wait_for_server_to_obtaine_state(server,
-                                               timeout,
-                                               sleep_time,
+                                               wait,
                                                NodeState.TERMINATED)
 
-    def wait_for_server_to_be_running(self, server, timeout, sleep_time):
+    def wait_for_server_to_be_running(self, server, wait):
         self._wait_for_server_to_obtaine_state(server,
-                                               timeout,
-                                               sleep_time,
+                                               wait,
                                                NodeState.RUNNING)
 
-    def _wait_for_server_to_obtaine_state(self,
-                                          server,
-                                          timeout,
-                                          sleep_time,
-                                          state):
-        while server.state is not state:
-            timeout -= 5
-            if timeout <= 0:
-                raise RuntimeError('Server {} has not been deleted.'
-                                   ' Waited for {} seconds'
-                                   .format(server.id, timeout))
-            time.sleep(sleep_time)
-            server = self.get_by_id(server.id)
+    def _wait_for_server_to_obtaine_state(self, server, wait, state):
+        poller = _state_poller(self.driver)
+        while server.state != state:
+            if wait.expired():
+                raise RuntimeError('Server {0} has not obtained state {1}.'
+                                   ' Waited for {2} seconds'
+                                   .format(server.id, state, wait.timeout))
+            wait.sleep('Waiting for server {0} to obtain state {1}'
+                       .format(server.id, state))
+            # Keep the last known node while it is not visible yet
+            server = poller.poll(self.driver, server.id) or server
+
+    def is_server_terminated(self, server_id):
+        return _termination_tracker.is_terminated(self.driver, server_id)
 
     def connect_floating_ip(self, server, ip):
         self.driver.ex_associate_address_with_node(server, ip)
@@ -77,40 +658,57 @@ class EC2LibcloudServerClient(LibcloudServerClient):
     def disconnect_floating_ip(self, ip):
         self.driver.ex_disassociate_address(ip)
 
-    def get_image_by_name(self, image_name):
-        images = self.driver.list_images(ex_image_ids=[image_name])
-        if images:
-            if images[0]:
-                return images[0]
+    def get_image_by_name(self, image_name, owner=None, filters=None):
+        return _image_resolver.resolve(self.driver,
+                                       image_name,
+                                       owner=owner,
+                                       filters=filters)
 
     def get_size_by_name(self, size_name):
-        sizes = self.driver.list_sizes()
-        if sizes:
-            for item in sizes:
-                if item.id == size_name:
-                    return item
+        return _size_catalog.get(
+            self.driver,
+            size_name,
+            ttl=self.config.get('size_catalog_ttl', SIZE_CATALOG_TTL))
+
+    def refresh_size_catalog(self):
+        return _size_catalog.refresh(self.driver)['sizes'].keys()
 
     def is_server_active(self, server):
         return server.state == NodeState.RUNNING
 
+    def resolve_launch_parameters(self, server_context):
+        if 'image_name' in server_context:
+            image = self.get_image_by_name(
+                server_context['image_name'],
+                owner=server_context.get('image_owner'),
+                filters=server_context.get('image_filters'))
+            if image is None:
+                raise NonRecoverableError("Image '{0}' not found".format(
+                    server_context['image_name']))
+        else:
+            raise NonRecoverableError("Image is a required parameter")
+        if 'size_name' in server_context:
+            size = self.get_size_by_name(server_context['size_name'])
+        else:
+            raise NonRecoverableError("Size is a required parameter")
+        return {'image': image, 'size': size}
+
     def create(
             self,
             name,
             ctx,
             server_context,
-            provider_context):
+            provider_context,
+            launch_parameters=None):
 
         def rename(name):
             return transform_resource_name(name, ctx)
 
-        if 'image_name' in server_context:
-            image = self.get_image_by_name(server_context['image_name'])
-        else:
-            raise NonRecoverableError("Image is a required parameter")
-        if 'size_name' in server_context:
-            size = self.get_size_by_name(server_context['size_name'])
-        else:
-            raise NonRecoverableError("Size is a required parameter")
+        if launch_parameters is None:
+            launch_parameters = self.resolve_launch_parameters(
+                server_context)
+        image = launch_parameters['image']
+        size = launch_parameters['size']
 
         security_groups = map(rename,
                               server_context.get('security_groups', []))
@@ -129,11 +727,58 @@ class EC2LibcloudServerClient(LibcloudServerClient):
 
         ctx.logger.error(security_groups)
 
-        node = self.driver.create_node(name=name,
-                                       image=image,
-                                       size=size,
-                                       ex_keyname=key_name,
-                                       ex_security_groups=security_groups)
+        tags = {
+            DEPLOYMENT_ID_TAG: ctx.deployment.id,
+            NODE_ID_TAG: ctx.node.id,
+            NODE_INSTANCE_ID_TAG: ctx.instance.id,
+        }
+        journal = self._launch_journal()
+        if ctx.node.properties['batch_provisioning']:
+            # A retry would not form the same batch, so batched launches
+            # have no client token
+            client_token = None
+            launch_key = (ctx.deployment.id,
+                          ctx.node.id,
+                          image.id,
+                          size.id,
+                          key_name,
+                          tuple(sorted(security_groups)))
+            try:
+                node = _provisioning_batcher.create_node(
+                    self.driver,
+                    launch_key,
+                    name,
+                    tags,
+                    image=image,
+                    size=size,
+                    ex_keyname=key_name,
+                    ex_security_groups=security_groups)
+            except UntaggedNodeError as e:
+                # A retry finds the instance here and tags it
+                journal.complete(self.driver,
+                                 ctx.deployment.id,
+                                 ctx.instance.id,
+                                 client_token,
+                                 e.node.id)
+                raise
+        else:
+            client_token = _client_token(ctx)
+            journal.begin(self.driver,
+                          ctx.deployment.id,
+                          ctx.instance.id,
+                          client_token)
+            node = self.driver.create_node(name=name,
+                                           image=image,
+                                           size=size,
+                                           ex_keyname=key_name,
+                                           ex_security_groups=security_groups,
+                                           ex_metadata=tags,
+                                           ex_clienttoken=client_token)
+        journal.complete(self.driver,
+                         ctx.deployment.id,
+                         ctx.instance.id,
+                         client_token,
+                         node.id)
         return node
 
 
@@ -142,17 +787,40 @@ class EC2LibcloudFloatingIPClient(LibcloudFloatingIPClient):
     def delete(self, ip):
         self.driver.ex_disassociate_address(ip)
         self.driver.ex_release_address(ip)
+        _address_cache.discard(self.driver, ip.ip)
 
     def create(self, **kwargs):
-        return self.driver.ex_allocate_address()
+        address = self.driver.ex_allocate_address()
+        _address_cache.put(self.driver, address)
+        return address
 
     def get_by_ip(self, ip):
-        addresses = self.driver.ex_describe_all_addresses()
-        for address in addresses:
+        address = _address_cache.get(self.driver, ip)
+        if address is not None:
+            return address
+        # A public-ip filter, unlike PublicIp.N, does not fail for an
+        # unknown address.
+        params = {'Action': 'DescribeAddresses'}
+        params.update(self.driver._build_filters({'public-ip': ip}))
+        response = self.driver.connection.request(self.driver.path,
+                                                  params=params).object
+        for address in self.driver._to_addresses(response, False):
             if address.ip == ip:
+                _address_cache.put(self.driver, address)
                 return address
 
 
+SECURITY_GROUP_RULES_PER_REQUEST = 25
+MISSING_GROUP_RE = re.compile(r"security group '([^']*)' does not exist")
+# Errors caused by the rules of a request rather than by the request
+RULE_ERROR_CODES = ('InvalidPermission.', 'InvalidParameterValue')
+
+
+def _is_rule_error(e):
+    message = str(e)
+    return any(code in message for code in RULE_ERROR_CODES)
+
+
 class EC2LibcloudSecurityGroupClient(LibcloudSecurityGroupClient):
 
     def create(self, security_group):
@@ -164,10 +832,36 @@ class EC2LibcloudSecurityGroupClient(LibcloudSecurityGroupClient):
         self.driver.ex_delete_security_group_by_id(id)
 
     def get_list_by_name(self, name):
-        try:
-            return self.driver.ex_get_security_groups(group_names=[name])
-        except:
-            return None
+        return self.get_lists_by_names([name])[name]
+
+    def get_lists_by_names(self, names):
+        # GroupName.N only matches groups of EC2-Classic or the default
+        # VPC, which are the groups referred to by name; a group-name filter
+        # would also return the same-named groups of every other VPC. One
+        # missing group, e.g. the one about to be created, fails the whole
+        # request; it is named in the error and the rest are looked up
+        # again without it.
+        result = dict((name, []) for name in names)
+        remaining = list(result)
+        while remaining:
+            try:
+                groups = self.driver.ex_get_security_groups(
+                    group_names=remaining)
+            except Exception as e:
+                if 'InvalidGroup.NotFound' not in str(e):
+                    raise
+                match = MISSING_GROUP_RE.search(str(e))
+                if match and match.group(1) in remaining:
+                    remaining.remove(match.group(1))
+                    continue
+                if len(remaining) > 1:
+                    for name in remaining:
+                        result[name] = self.get_lists_by_names([name])[name]
+                return result
+            for sg in groups:
+                result.setdefault(sg.name, []).append(sg)
+            break
+        return result
 
     def get_description(self, sg):
         return sg.extra['description']
@@ -179,25 +873,22 @@ class EC2LibcloudSecurityGroupClient(LibcloudSecurityGroupClient):
             return sg.id
 
     def get_rules(self, sg):
+        # EC2 merges rules with the same protocol and ports into a single
+        # permission, so one rule is returned per CIDR and per group pair.
         result = []
         for rule in sg.ingress_rules:
-            sgr = {
-                'direction': 'ingress',
-                'port_range_max': rule['to_port'],
-                'port_range_min': rule['from_port'],
-                'protocol': rule['protocol'],
-                'remote_group_id': None,
-                'remote_ip_prefix': '0.0.0.0/0',
-            }
-            if 'group_pairs' in rule:
-                if len(rule['group_pairs']) > 0:
-                    sgr['remote_group_id'] = rule['group_pairs'][0]['group_id']
-                    del sgr['remote_ip_prefix']
-            if 'cidr_ips' in rule:
-                if len(rule['cidr_ips']) > 0:
-                    sgr['remote_ip_prefix'] = rule['cidr_ips'][0]
-                    del sgr['remote_group_id']
-            result.append(sgr)
+            sources = [(None, group_pair['group_id'])
+                       for group_pair in rule.get('group_pairs') or []]
+            sources += [(cidr_ip, None)
+                        for cidr_ip in rule.get('cidr_ips') or []]
+            for remote_ip_prefix, remote_group_id in \
+                    sources or [('0.0.0.0/0', None)]:
+                result.append(SecurityGroupRule.normalized(
+                    rule['protocol'],
+                    rule['from_port'],
+                    rule['to_port'],
+                    remote_ip_prefix=remote_ip_prefix,
+                    remote_group_id=remote_group_id))
         return result
 
     def create_security_group_rule(self, rule):
@@ -214,6 +905,59 @@ class EC2LibcloudSecurityGroupClient(LibcloudSecurityGroupClient):
                 rule['port_range_max'],
                 group_pairs=[{'group_id': rule['remote_group_id']}])
 
+    def create_security_group_rules(self, security_group_id, rules):
+        return self._update_ingress_rules('AuthorizeSecurityGroupIngress',
+                                          security_group_id,
+                                          rules)
+
+    def revoke_security_group_rules(self, security_group_id, rules):
+        return self._update_ingress_rules('RevokeSecurityGroupIngress',
+                                          security_group_id,
+                                          rules)
+
+    def _update_ingress_rules(self, action, security_group_id, rules):
+        # Sends up to SECURITY_GROUP_RULES_PER_REQUEST IP permissions per
+        # call. A chunk failed by one of its rules is retried rule by rule
+        # to find the offending rules, which are returned as (rule, error)
+        # pairs. Any other error, e.g. throttling, is raised.
+        failures = []
+        rules = [rule for rule in rules
+                 if rule.remote_group_id or rule.remote_ip_prefix]
+        for i in range(0, len(rules), SECURITY_GROUP_RULES_PER_REQUEST):
+            chunk = rules[i:i + SECURITY_GROUP_RULES_PER_REQUEST]
+            try:
+                self._request_ingress(action, security_group_id, chunk)
+            except Exception as e:
+                if not _is_rule_error(e):
+                    raise
+                if len(chunk) == 1:
+                    failures.append((chunk[0], e))
+                    continue
+                for rule in chunk:
+                    try:
+                        self._request_ingress(action,
+                                              security_group_id,
+                                              [rule])
+                    except Exception as e:
+                        if not _is_rule_error(e):
+                            raise
+                        failures.append((rule, e))
+        return failures
+
+    def _request_ingress(self, action, security_group_id, rules):
+        params = {'Action': action,
+                  'GroupId': security_group_id}
+        for index, rule in enumerate(rules, 1):
+            prefix = 'IpPermissions.{0}.'.format(index)
+            params[prefix + 'IpProtocol'] = rule.protocol
+            params[prefix + 'FromPort'] = rule.port_range_min
+            params[prefix + 'ToPort'] = rule.port_range_max
+            if rule.remote_group_id:
+                params[prefix + 'Groups.1.GroupId'] = rule.remote_group_id
+            else:
+                params[prefix + 'IpRanges.1.CidrIp'] = rule.remote_ip_prefix
+        self.driver.connection.request(self.driver.path, params=params)
+
 
 class EC2LibcloudProviderContext(LibcloudProviderContext):
 
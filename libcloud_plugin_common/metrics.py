@@ -0,0 +1,223 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import contextlib
+import copy
+import errno
+import os
+import re
+import socket
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling')
+STATSD_PREFIX = 'libcloud_plugin'
+TEXTFILE_PREFIX = 'libcloud_plugin_api'
+TEXTFILE_NAME = re.compile(r'^libcloud_plugin_(\d+)\.prom$')
+
+
+def is_throttling_error(e):
+    message = str(e)
+    return any(code in message for code in THROTTLING_ERROR_CODES)
+
+
+class ApiMetrics(object):
+    # Counts, latency histograms and error/throttle counts per plugin
+    # operation and API action. Every API call of an instrumented driver
+    # goes through its connection's request method, which is wrapped here.
+    #
+    # Connection config keys:
+    #   metrics_statsd_address - "host:port" of a StatsD UDP sink
+    #   metrics_textfile_dir - directory for a Prometheus textfile per
+    #                          process, rewritten at the end of every
+    #                          operation
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._socket = None
+        self._cleaned_dirs = set()
+
+    @contextlib.contextmanager
+    def operation(self, name, config):
+        outermost = getattr(self._local, 'operation', None) is None
+        try:
+            with self.continued((name, config)):
+                yield
+        finally:
+            # Nested operations are part of the outermost one
+            textfile_dir = config.get('metrics_textfile_dir')
+            if outermost and textfile_dir:
+                try:
+                    self.write_textfile(textfile_dir)
+                except (IOError, OSError):
+                    # Metrics must never fail an operation
+                    pass
+
+    @contextlib.contextmanager
+    def continued(self, operation):
+        # Records the calls of this thread for an operation running in
+        # another one
+        previous = getattr(self._local, 'operation', None)
+        self._local.operation = operation
+        try:
+            yield
+        finally:
+            self._local.operation = previous
+
+    def current_operation(self):
+        # (name, config) of the operation running in this thread, if any
+        return getattr(self._local, 'operation', None)
+
+    def instrument(self, driver):
+        connection = driver.connection
+        if getattr(connection, '_libcloud_plugin_instrumented', False):
+            return driver
+        request = connection.request
+
+        def instrumented_request(action, params=None, *args, **kwargs):
+            api_action = (params or {}).get('Action', action)
+            start = time.time()
+            try:
+                response = request(action, params, *args, **kwargs)
+            except Exception as e:
+                self.record(api_action, time.time() - start, e)
+                raise
+            self.record(api_action, time.time() - start)
+            return response
+
+        connection.request = instrumented_request
+        connection._libcloud_plugin_instrumented = True
+        return driver
+
+    def record(self, action, latency, error=None):
+        operation, config = getattr(self._local, 'operation', None) or \
+            ('unknown', {})
+        throttled = error is not None and is_throttling_error(error)
+        with self._lock:
+            series = self._series.get((operation, action))
+            if series is None:
+                series = self._series[(operation, action)] = {
+                    'count': 0,
+                    'errors': 0,
+                    'throttles': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                }
+            series['count'] += 1
+            series['sum'] += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    series['buckets'][i] += 1
+            if error is not None:
+                series['errors'] += 1
+            if throttled:
+                series['throttles'] += 1
+        address = config.get('metrics_statsd_address')
+        if address:
+            self._send_statsd(address, operation, action, latency,
+                              error is not None, throttled)
+
+    def snapshot(self):
+        with self._lock:
+            return copy.deepcopy(self._series)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def write_textfile(self, directory):
+        series = self.snapshot()
+        pid = os.getpid()
+        lines = []
+        for name, kind, key in (('calls_total', 'counter', 'count'),
+                                ('errors_total', 'counter', 'errors'),
+                                ('throttles_total', 'counter', 'throttles')):
+            lines.append('# TYPE {0}_{1} {2}'.format(TEXTFILE_PREFIX,
+                                                     name,
+                                                     kind))
+            for (operation, action), values in sorted(series.items()):
+                lines.append('{0}_{1}{{{2}}} {3}'.format(
+                    TEXTFILE_PREFIX, name,
+                    self._labels(operation, action, pid), values[key]))
+        name = '{0}_latency_seconds'.format(TEXTFILE_PREFIX)
+        lines.append('# TYPE {0} histogram'.format(name))
+        for (operation, action), values in sorted(series.items()):
+            labels = self._labels(operation, action, pid)
+            for bound, count in zip(LATENCY_BUCKETS, values['buckets']):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    name, labels, le, count))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                name, labels, values['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                name, labels, values['count']))
+        if directory not in self._cleaned_dirs:
+            self._remove_stale_textfiles(directory)
+            self._cleaned_dirs.add(directory)
+        # Written aside and renamed, so collectors never see a partial file
+        path = os.path.join(directory, 'libcloud_plugin_{0}.prom'.format(pid))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(path + '.tmp', path)
+
+    def _remove_stale_textfiles(self, directory):
+        # Files of worker processes that are gone
+        for name in os.listdir(directory):
+            match = TEXTFILE_NAME.match(name)
+            if match is None:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+                continue
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    # EPERM: alive, but owned by another user
+                    continue
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                # Removed by another worker
+                pass
+
+    def _labels(self, operation, action, pid):
+        return 'operation="{0}",action="{1}",pid="{2}"'.format(
+            operation, action, pid)
+
+    def _send_statsd(self, address, operation, action, latency, error,
+                     throttled):
+        host, _, port = address.rpartition(':')
+        name = '{0}.{1}.{2}'.format(STATSD_PREFIX, operation, action)
+        lines = ['{0}.calls:1|c'.format(name),
+                 '{0}.latency:{1}|ms'.format(name, int(latency * 1000))]
+        if error:
+            lines.append('{0}.errors:1|c'.format(name))
+        if throttled:
+            lines.append('{0}.throttles:1|c'.format(name))
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM)
+            self._socket.sendto('\n'.join(lines), (host, int(port)))
+        except (socket.error, ValueError):
+            # Metrics must never fail an operation
+            pass
+
+
+api_metrics = ApiMetrics()
@@ -0,0 +1,224 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import errno
+import hashlib
+import logging
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Buckets are then shared by the threads of one process only
+    fcntl = None
+
+from cloudify.exceptions import RecoverableError
+
+from libcloud_plugin_common.metrics import is_throttling_error
+
+
+DEFAULT_RATE_LIMIT = 20
+DEFAULT_BURST = 40
+DEFAULT_MAX_WAIT = 30
+DEFAULT_THROTTLE_RETRIES = 3
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(),
+                                 'cloudify-libcloud-rate-limits')
+# After a throttling error the rate drops by this factor, but not below
+# the given fraction of the limit. It then climbs back to the limit over
+# RATE_RECOVERY_TIME seconds.
+THROTTLE_RATE_FACTOR = 0.5
+MIN_RATE_FRACTION = 0.1
+RATE_RECOVERY_TIME = 60
+THROTTLE_BACKOFF = 0.5
+THROTTLE_JITTER = 0.2
+
+# tokens, updated_at, rate
+_STATE_FORMAT = '!ddd'
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    # A token bucket per account and region, shared by every worker
+    # process on the host through a locked state file. Throttling errors
+    # shrink the bucket's rate, which then recovers linearly, so the
+    # steady-state rate settles just below the account's limit instead of
+    # swinging between bursts and error storms. Throttled requests are
+    # retried a few times in place and then surface as RecoverableError,
+    # so the task is retried once the bucket has refilled.
+    #
+    # Connection config keys:
+    #   api_rate_limit - requests per second, 0 disables the bucket
+    #   api_rate_burst - requests allowed in a burst
+    #   api_rate_max_wait - longest in-process wait for a token, in seconds;
+    #                       the operation is retried later beyond that
+    #   api_throttle_retries - in-place retries of a throttled request
+    #   api_rate_state_dir - directory of the shared bucket files; if it
+    #                        cannot be used, e.g. it belongs to another
+    #                        user, the bucket is shared by the threads of
+    #                        this process only
+
+    def __init__(self):
+        self._settings = {}
+        self._buckets = {}
+        self._unshared = set()
+        self._lock = threading.Lock()
+
+    def instrument(self, driver, config):
+        key = self._bucket_key(driver)
+        limit = float(config.get('api_rate_limit', DEFAULT_RATE_LIMIT))
+        self._settings[key] = {
+            'limit': limit,
+            'burst': max(1.0, float(config.get('api_rate_burst',
+                                               DEFAULT_BURST))),
+            'max_wait': float(config.get('api_rate_max_wait',
+                                         DEFAULT_MAX_WAIT)),
+            'retries': int(config.get('api_throttle_retries',
+                                      DEFAULT_THROTTLE_RETRIES)),
+            'path': os.path.join(config.get('api_rate_state_dir',
+                                            DEFAULT_STATE_DIR),
+                                 key + '.bucket'),
+        }
+        connection = driver.connection
+        if getattr(connection, '_libcloud_plugin_rate_limited', False):
+            return driver
+        request = connection.request
+
+        def rate_limited_request(action, params=None, *args, **kwargs):
+            settings = self._settings[key]
+            attempt = 0
+            while True:
+                self.acquire(settings)
+                try:
+                    return request(action, params, *args, **kwargs)
+                except Exception as e:
+                    if not is_throttling_error(e):
+                        raise
+                    attempt += 1
+                    delay = self.throttled(settings, attempt)
+                    if attempt > settings['retries'] or \
+                            delay > settings['max_wait']:
+                        _, _, traceback = sys.exc_info()
+                        raise RecoverableError(
+                            message='API request throttled: {0}'.format(e),
+                            retry_after=int(math.ceil(delay)) or 1), \
+                            None, traceback
+                    time.sleep(delay)
+
+        connection.request = rate_limited_request
+        connection._libcloud_plugin_rate_limited = True
+        return driver
+
+    def acquire(self, settings):
+        if not settings['limit']:
+            return
+        wait = self._update(settings, self._take_token)
+        if wait:
+            time.sleep(wait)
+
+    def throttled(self, settings, attempt):
+        # Returns how long to wait before retrying
+        backoff = THROTTLE_BACKOFF * 2 ** (attempt - 1)
+        if settings['limit']:
+            backoff = max(backoff, self._update(settings, self._slow_down))
+        return backoff * random.uniform(1 - THROTTLE_JITTER,
+                                        1 + THROTTLE_JITTER)
+
+    def _take_token(self, settings, tokens, rate):
+        wait = (1 - tokens) / rate if tokens < 1 else 0
+        if wait > settings['max_wait']:
+            raise RecoverableError(
+                message='API rate limit of {0} requests per second '
+                        'reached'.format(settings['limit']),
+                retry_after=int(math.ceil(wait)))
+        # Tokens go negative for the requests already waiting
+        return tokens - 1, rate, wait
+
+    def _slow_down(self, settings, tokens, rate):
+        rate = max(settings['limit'] * MIN_RATE_FRACTION,
+                   rate * THROTTLE_RATE_FACTOR)
+        # Drop the burst allowance, it is what got throttled
+        tokens = min(tokens, 0)
+        return tokens, rate, (1 - tokens) / rate
+
+    def _refill(self, settings, state, now):
+        limit = settings['limit']
+        if state is None:
+            return settings['burst'], limit
+        tokens, updated_at, rate = state
+        elapsed = max(0, now - updated_at)
+        rate = min(limit, rate + elapsed * limit / RATE_RECOVERY_TIME)
+        return min(settings['burst'], tokens + elapsed * rate), rate
+
+    def _update(self, settings, change):
+        path = settings['path']
+        if fcntl is not None and path not in self._unshared:
+            try:
+                return self._update_shared(settings, change)
+            except OSError as e:
+                # Rate limiting must not fail the request
+                with self._lock:
+                    self._unshared.add(path)
+                logger.warning('Cannot use rate limit state file {0}, '
+                               'limiting the requests of this process '
+                               'only: {1}'.format(path, e))
+        with self._lock:
+            now = time.time()
+            tokens, rate = self._refill(settings,
+                                        self._buckets.get(path),
+                                        now)
+            tokens, rate, result = change(settings, tokens, rate)
+            self._buckets[path] = (tokens, now, rate)
+        return result
+
+    def _update_shared(self, settings, change):
+        fd = self._open(settings['path'])
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            data = os.read(fd, struct.calcsize(_STATE_FORMAT))
+            state = struct.unpack(_STATE_FORMAT, data) \
+                if len(data) == struct.calcsize(_STATE_FORMAT) else None
+            tokens, rate = self._refill(settings, state, now)
+            tokens, rate, result = change(settings, tokens, rate)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, struct.pack(_STATE_FORMAT, tokens, now, rate))
+            return result
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _open(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _bucket_key(self, driver):
+        return hashlib.sha1('{0}:{1}'.format(
+            driver.key, driver.region_name)).hexdigest()
+
+
+rate_limiter = RateLimiter()
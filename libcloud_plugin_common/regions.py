@@ -0,0 +1,87 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import threading
+import time
+
+
+CAPACITY_ERROR_CODES = ('InsufficientInstanceCapacity',
+                        'InstanceLimitExceeded',
+                        'Unsupported')
+# Weight of the latest response time in a region's latency
+LATENCY_SMOOTHING = 0.3
+# Keeps the other factors of a cost meaningful for a very close endpoint
+MIN_LATENCY = 0.001
+# Every capacity error of a region within CAPACITY_ERROR_TTL seconds
+# multiplies its cost by CAPACITY_ERROR_PENALTY
+CAPACITY_ERROR_TTL = 10 * 60
+CAPACITY_ERROR_PENALTY = 4
+
+
+def is_capacity_error(e):
+    message = str(e)
+    return any(code in message for code in CAPACITY_ERROR_CODES)
+
+
+class RegionStats(object):
+    # API latency and recent capacity errors per region, as seen by this
+    # process, used to place servers in multi-region mode.
+    #
+    # Connection config key:
+    #   regions - cloud provider names, e.g. ["ec2-us-west"], servers may
+    #             be placed in besides cloud_provider_name. Their key pair,
+    #             security groups and images are looked up by name in the
+    #             region the server is placed in, so they must exist in
+    #             every listed region. Security groups and floating IPs of
+    #             this plugin are only managed in cloud_provider_name, so
+    #             servers related to them are rejected.
+
+    def __init__(self):
+        self._latency = {}
+        self._capacity_errors = {}
+        self._lock = threading.Lock()
+
+    def record_latency(self, region, seconds):
+        with self._lock:
+            latency = self._latency.get(region)
+            self._latency[region] = seconds if latency is None else \
+                latency + LATENCY_SMOOTHING * (seconds - latency)
+
+    def record_capacity_error(self, region):
+        with self._lock:
+            self._capacity_errors.setdefault(region, []).append(time.time())
+
+    def rank(self, regions, placed):
+        # Regions holding fewer servers of the node come first, weighted by
+        # their latency and recent capacity errors, so a scaled node
+        # spreads over the healthy regions. Ties keep the given order.
+        now = time.time()
+        with self._lock:
+            costs = {}
+            for region in regions:
+                errors = [t for t in self._capacity_errors.get(region, [])
+                          if now - t <= CAPACITY_ERROR_TTL]
+                self._capacity_errors[region] = errors
+                costs[region] = (max(MIN_LATENCY,
+                                     self._latency.get(region, 0)) *
+                                 (1 + placed.get(region, 0)) *
+                                 CAPACITY_ERROR_PENALTY ** len(errors))
+        return sorted(regions,
+                      key=lambda region: (costs[region],
+                                          regions.index(region)))
+
+
+region_stats = RegionStats()
@@ -0,0 +1,160 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudify.exceptions import RecoverableError
+
+from libcloud_plugin_common import rate_limit
+from libcloud_plugin_common.rate_limit import RateLimiter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Time stands still, as for concurrent callers waiting together
+        self.sleeps.append(seconds)
+
+
+class FakeConnection(object):
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.requests = 0
+
+    def request(self, action, params=None):
+        self.requests += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return action
+
+
+class FakeDriver(object):
+
+    key = 'key'
+    region_name = 'region'
+
+    def __init__(self, errors=()):
+        self.connection = FakeConnection(errors)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self._time = rate_limit.time
+        rate_limit.time = self.clock
+        self.limiter = RateLimiter()
+
+    def tearDown(self):
+        rate_limit.time = self._time
+        shutil.rmtree(self.state_dir)
+
+    def _settings(self, limit=10, burst=2, max_wait=30, retries=3):
+        return {'limit': float(limit),
+                'burst': float(burst),
+                'max_wait': float(max_wait),
+                'retries': retries,
+                'path': os.path.join(self.state_dir, 'test.bucket')}
+
+    def test_burst_then_rate(self):
+        settings = self._settings()
+        for _ in range(3):
+            self.limiter.acquire(settings)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 0.1)
+
+    def test_bucket_refills_up_to_burst(self):
+        settings = self._settings()
+        self.limiter.acquire(settings)
+        self.limiter.acquire(settings)
+        self.clock.now += 60
+        for _ in range(2):
+            self.limiter.acquire(settings)
+        self.assertEqual(self.clock.sleeps, [])
+        self.limiter.acquire(settings)
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_max_wait_raises_recoverable_error(self):
+        settings = self._settings(limit=1, burst=1, max_wait=2)
+        self.limiter.acquire(settings)
+        self.limiter.acquire(settings)
+        self.limiter.acquire(settings)
+        with self.assertRaises(RecoverableError) as raised:
+            self.limiter.acquire(settings)
+        self.assertEqual(raised.exception.retry_after, 3)
+        self.assertEqual(self.clock.sleeps, [1, 2])
+
+    def test_throttle_backoff_grows(self):
+        settings = self._settings(limit=0)
+        for attempt in range(1, 4):
+            backoff = rate_limit.THROTTLE_BACKOFF * 2 ** (attempt - 1)
+            delay = self.limiter.throttled(settings, attempt)
+            self.assertTrue(
+                backoff * (1 - rate_limit.THROTTLE_JITTER) <= delay <=
+                backoff * (1 + rate_limit.THROTTLE_JITTER))
+
+    def test_throttle_slows_rate_down_then_recovers(self):
+        settings = self._settings(limit=10, burst=10)
+        self.limiter.acquire(settings)
+        delay = self.limiter.throttled(settings, 1)
+        # The burst is dropped and the rate halved
+        self.assertTrue(delay >= 0.2 * (1 - rate_limit.THROTTLE_JITTER))
+        self.clock.now += rate_limit.RATE_RECOVERY_TIME / 2.0
+        self.limiter.acquire(settings)
+        self.assertEqual(self.clock.sleeps, [])
+        for _ in range(10):
+            self.limiter.acquire(settings)
+        self.assertAlmostEqual(self.clock.sleeps[-1], 0.1)
+
+    def test_throttled_request_is_retried(self):
+        driver = FakeDriver([Exception('RequestLimitExceeded')])
+        self.limiter.instrument(driver, {'api_rate_state_dir':
+                                         self.state_dir})
+        self.assertEqual(driver.connection.request('DescribeInstances'),
+                         'DescribeInstances')
+        self.assertEqual(driver.connection.requests, 2)
+
+    def test_throttled_request_raises_after_retries(self):
+        driver = FakeDriver([Exception('Throttling')] * 3)
+        self.limiter.instrument(driver, {'api_rate_state_dir':
+                                         self.state_dir,
+                                         'api_throttle_retries': 2})
+        with self.assertRaises(RecoverableError):
+            driver.connection.request('DescribeInstances')
+        self.assertEqual(driver.connection.requests, 3)
+
+    def test_unusable_state_dir_limits_this_process(self):
+        settings = self._settings()
+        # A file where the state directory should be
+        blocker = os.path.join(self.state_dir, 'blocker')
+        open(blocker, 'w').close()
+        settings['path'] = os.path.join(blocker, 'test.bucket')
+        for _ in range(3):
+            self.limiter.acquire(settings)
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 0.1)
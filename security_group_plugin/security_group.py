@@ -14,14 +14,16 @@
 #  * limitations under the License.
 
 
+import collections
 import re
-import copy
-import json
+import socket
+import struct
 
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
 from libcloud_plugin_common import (with_security_group_client,
-                                    transform_resource_name)
+                                    transform_resource_name,
+                                    SecurityGroupRule)
 
 
 NODE_NAME_RE = re.compile('^(.*)_.*$')  # Anything before last underscore
@@ -38,9 +40,18 @@ def create(ctx, security_group_client, **kwargs):
     security_group.update(ctx.node.properties['security_group'])
     transform_resource_name(security_group, ctx)
 
-    existing_sg = _find_existing_sg(ctx,
-                                    security_group_client,
-                                    security_group['name'])
+    rules_to_apply = ctx.node.properties['rules']
+
+    # One lookup for the group itself and every remote_group_name
+    security_groups_by_name = security_group_client.get_lists_by_names(
+        [security_group['name']] +
+        [rule['remote_group_name'] for rule in rules_to_apply
+         if rule.get('remote_group_name')])
+
+    existing_sg = _find_existing_sg(
+        ctx,
+        security_groups_by_name[security_group['name']],
+        security_group['name'])
     if existing_sg:
         existing_description = security_group_client\
             .get_description(existing_sg)
@@ -54,9 +65,8 @@ def create(ctx, security_group_client, **kwargs):
                                       " Security group name: {0}".format(
                                           security_group['name']))
 
-    rules_to_apply = ctx.node.properties['rules']
-
     security_group_rules = []
+    capabilities = None
     for rule in rules_to_apply:
         ctx.logger.debug(
             "security_group.create() rule before transformations: {0}".format(
@@ -75,15 +85,16 @@ def create(ctx, security_group_client, **kwargs):
             del sgr['port']
 
         if ('remote_group_node' in sgr) and sgr['remote_group_node']:
+            if capabilities is None:
+                capabilities = _capabilities_by_node_name(ctx)
             _, remote_group_node = _capabilities_of_node_named(
-                sgr['remote_group_node'], ctx)
+                sgr['remote_group_node'], capabilities)
             sgr['remote_ip_prefix'] = remote_group_node.ip
             del sgr['remote_group_node']
             del sgr['remote_ip_prefix']
 
         if ('remote_group_name' in sgr) and sgr['remote_group_name']:
-            sgroups = security_group_client\
-                .get_list_by_name(sgr['remote_group_name'])
+            sgroups = security_groups_by_name[sgr['remote_group_name']]
             sg_count = len(sgroups)
             if sg_count > 1:
                 raise NonRecoverableError('More than one security group found'
@@ -97,22 +108,44 @@ def create(ctx, security_group_client, **kwargs):
             del sgr['remote_group_name']
             del sgr['remote_ip_prefix']
 
+        sgr = SecurityGroupRule.from_dict(sgr)
         ctx.logger.debug(
             "security_group.create() rule after transformations: {0}".format(
                 sgr))
         security_group_rules.append(sgr)
 
+    if ctx.node.properties['compact_rules']:
+        compacted = _compact_sg_rules(security_group_rules)
+        ctx.logger.info("Compacted {0} security group rules into {1}, "
+                        "saving {2}".format(
+                            len(security_group_rules),
+                            len(compacted),
+                            len(security_group_rules) - len(compacted)))
+        security_group_rules = compacted
+
     if existing_sg:
         r1 = security_group_client.get_rules(existing_sg)
         r2 = security_group_rules
+        existing_sg_id = security_group_client.get_id(existing_sg)
         if _sg_rules_are_equal(r1, r2):
-            existing_sg_id = security_group_client.get_id(existing_sg)
             ctx.logger.info("Using existing security group named '{0}' with "
                             "id {1}".format(
                                 security_group['name'],
                                 existing_sg_id))
             ctx.instance.runtime_properties['external_id'] = existing_sg_id
             return
+        elif ctx.node.properties['reconcile_rules'] or \
+                ctx.instance.runtime_properties.get('external_id') == \
+                existing_sg_id:
+            # A retried create, e.g. after throttling, also finishes
+            # applying the rules of the group it created
+            _reconcile_sg_rules(ctx,
+                                security_group_client,
+                                existing_sg_id,
+                                r1,
+                                r2)
+            ctx.instance.runtime_properties['external_id'] = existing_sg_id
+            return
         else:
             raise RulesMismatchError("Rules of existing security group"
                                      " and the security group to be created "
@@ -127,12 +160,19 @@ def create(ctx, security_group_client, **kwargs):
 
     sg = security_group_client.create(security_group)
     sg_id = security_group_client.get_id(sg)
-
-    for sgr in security_group_rules:
-        sgr['security_group_id'] = sg_id
-        security_group_client.create_security_group_rule(sgr)
     ctx.instance.runtime_properties['external_id'] = sg_id
 
+    failures = security_group_client.create_security_group_rules(
+        sg_id, security_group_rules)
+    if failures:
+        raise NonRecoverableError("Failed to apply {0} of {1} rules to "
+                                  "security group '{2}': {3}".format(
+                                      len(failures),
+                                      len(security_group_rules),
+                                      security_group['name'],
+                                      ["{0}: {1}".format(rule, e)
+                                       for rule, e in failures]))
+
 
 @operation
 @with_security_group_client
@@ -144,10 +184,8 @@ def delete(ctx, security_group_client, **kwargs):
         raise NonRecoverableError("Security group client error: " + str(e))
 
 
-def _find_existing_sg(ctx, security_group_client, name):
-    existing_sgs = security_group_client.get_list_by_name(name)
+def _find_existing_sg(ctx, existing_sgs, name):
     if existing_sgs:
-        existing_sgs = list(existing_sgs)
         if len(existing_sgs) > 1:
             raise NonRecoverableError("Multiple security groups with name"
                                       " '{0}' already exist while trying"
@@ -162,37 +200,126 @@ def _find_existing_sg(ctx, security_group_client, name):
     return None
 
 
-def _capabilities_of_node_named(node_name, ctx):
-    result = None
+def _capabilities_by_node_name(ctx):
+    result = collections.defaultdict(list)
     caps = ctx.capabilities.get_all()
     for node_id in caps:
         match = NODE_NAME_RE.match(node_id)
         if match:
-            candidate_node_name = match.group(1)
-            if candidate_node_name == node_name:
-                if result:
-                    raise NonRecoverableError(
-                        "More than one node named '{0}' "
-                        "in capabilities".format(node_name))
-                result = (node_id, caps[node_id])
+            result[match.group(1)].append((node_id, caps[node_id]))
+    return result
+
+
+def _capabilities_of_node_named(node_name, capabilities):
+    result = capabilities.get(node_name)
     if not result:
         raise NonRecoverableError(
             "Could not find node named '{0}' "
             "in capabilities".format(node_name))
-    return result
+    if len(result) > 1:
+        raise NonRecoverableError(
+            "More than one node named '{0}' "
+            "in capabilities".format(node_name))
+    return result[0]
+
+
+def _reconcile_sg_rules(ctx, security_group_client, sg_id, existing, wanted):
+    to_add, to_revoke = _sg_rules_delta(existing, wanted)
+    ctx.logger.info("Reconciling security group {0}: adding {1} and "
+                    "revoking {2} rules".format(
+                        sg_id, len(to_add), len(to_revoke)))
+    # Add before revoking so traffic allowed by both sets is never cut
+    failures = security_group_client.create_security_group_rules(
+        sg_id, to_add)
+    failures += security_group_client.revoke_security_group_rules(
+        sg_id, to_revoke)
+    if failures:
+        raise NonRecoverableError("Failed to reconcile {0} rules of "
+                                  "security group {1}: {2}".format(
+                                      len(failures),
+                                      sg_id,
+                                      ["{0}: {1}".format(rule, e)
+                                       for rule, e in failures]))
+
+
+def _sg_rules_delta(existing, wanted):
+    existing = set(existing)
+    wanted = set(wanted)
+    return list(wanted - existing), list(existing - wanted)
 
 
 def _sg_rules_are_equal(r1, r2):
-    s1 = map(_serialize_sg_rule_for_comparison, r1)
-    s2 = map(_serialize_sg_rule_for_comparison, r2)
-    return set(s1) == set(s2)
+    return set(r1) == set(r2)
+
+
+def _compact_sg_rules(rules):
+    # Coalesces overlapping or adjacent tcp/udp port ranges of rules with
+    # the same source, then merges IPv4 CIDRs of rules with the same ports
+    # into supernets.
+    rules = set(rules)
+    by_source = collections.defaultdict(list)
+    for rule in list(rules):
+        if rule.protocol in ('tcp', 'udp') and rule.port_range_min >= 0:
+            rules.remove(rule)
+            by_source[rule._replace(port_range_min=None,
+                                    port_range_max=None)].append(
+                (rule.port_range_min, rule.port_range_max))
+    for source, port_ranges in by_source.items():
+        for port_range_min, port_range_max in _merge_port_ranges(port_ranges):
+            rules.add(source._replace(port_range_min=port_range_min,
+                                      port_range_max=port_range_max))
+
+    by_ports = collections.defaultdict(list)
+    for rule in list(rules):
+        network = _parse_ipv4_cidr(rule.remote_ip_prefix)
+        if network is not None:
+            rules.remove(rule)
+            by_ports[rule._replace(remote_ip_prefix=None)].append(network)
+    for ports, networks in by_ports.items():
+        for address, prefix in _collapse_ipv4_networks(networks):
+            rules.add(ports._replace(remote_ip_prefix='{0}/{1}'.format(
+                socket.inet_ntoa(struct.pack('!I', address)), prefix)))
+    return sorted(rules)
+
+
+def _merge_port_ranges(port_ranges):
+    merged = []
+    for port_range_min, port_range_max in sorted(port_ranges):
+        if merged and port_range_min <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], port_range_max)
+        else:
+            merged.append([port_range_min, port_range_max])
+    return merged
 
 
-def _serialize_sg_rule_for_comparison(security_group_rule):
-    r = copy.deepcopy(security_group_rule)
-    if 'remote_group_id' in r:
-        del r['remote_group_id']
-    return json.dumps(r, sort_keys=True)
+def _parse_ipv4_cidr(cidr):
+    if not cidr:
+        return None
+    address, _, prefix = cidr.partition('/')
+    try:
+        return (struct.unpack('!I', socket.inet_aton(address))[0],
+                int(prefix or 32))
+    except socket.error:
+        return None
+
+
+def _collapse_ipv4_networks(networks):
+    networks = set(networks)
+    # Merge sibling networks bottom-up; parents created at one prefix
+    # length are merged again at the next
+    for prefix in range(32, 0, -1):
+        size = 1 << (32 - prefix)
+        for address, _ in [n for n in networks if n[1] == prefix]:
+            sibling = address ^ size
+            if (address, prefix) in networks and \
+                    (sibling, prefix) in networks:
+                networks -= set([(address, prefix), (sibling, prefix)])
+                networks.add((min(address, sibling), prefix - 1))
+    # Drop networks covered by a larger one
+    return sorted(
+        (address, prefix) for address, prefix in networks
+        if not any(((address >> (32 - p)) << (32 - p) if p else 0, p)
+                   in networks for p in range(prefix)))
 
 
 class RulesMismatchError(NonRecoverableError):
@@ -0,0 +1,103 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import unittest
+
+from libcloud_plugin_common import SecurityGroupRule
+from security_group_plugin.security_group import (_collapse_ipv4_networks,
+                                                  _compact_sg_rules,
+                                                  _parse_ipv4_cidr)
+
+
+def _rule(cidr, port_range_min=22, port_range_max=None, protocol='tcp'):
+    return SecurityGroupRule.normalized(
+        protocol, port_range_min,
+        port_range_min if port_range_max is None else port_range_max,
+        remote_ip_prefix=cidr)
+
+
+def _networks(*cidrs):
+    return [_parse_ipv4_cidr(cidr) for cidr in cidrs]
+
+
+class CollapseIPv4NetworksTest(unittest.TestCase):
+
+    def test_merges_siblings(self):
+        self.assertEqual(
+            _collapse_ipv4_networks(_networks('10.0.0.0/25', '10.0.0.128/25')),
+            _networks('10.0.0.0/24'))
+
+    def test_merges_parents_of_siblings(self):
+        self.assertEqual(
+            _collapse_ipv4_networks(_networks('10.0.0.0/26', '10.0.0.64/26',
+                                              '10.0.0.128/25')),
+            _networks('10.0.0.0/24'))
+
+    def test_keeps_non_siblings(self):
+        # Adjacent, but not halves of the same /24
+        networks = _networks('10.0.0.128/25', '10.0.1.0/25')
+        self.assertEqual(_collapse_ipv4_networks(networks), sorted(networks))
+
+    def test_drops_covered_networks(self):
+        self.assertEqual(
+            _collapse_ipv4_networks(_networks('10.0.0.0/16', '10.0.3.0/24',
+                                              '10.0.200.7/32')),
+            _networks('10.0.0.0/16'))
+
+    def test_everything_covers_all(self):
+        self.assertEqual(
+            _collapse_ipv4_networks(_networks('0.0.0.0/0', '192.168.1.1/32')),
+            _networks('0.0.0.0/0'))
+
+
+class CompactSecurityGroupRulesTest(unittest.TestCase):
+
+    def test_coalesces_overlapping_and_adjacent_ports(self):
+        rules = [_rule('10.0.0.0/24', 80, 90),
+                 _rule('10.0.0.0/24', 85, 100),
+                 _rule('10.0.0.0/24', 101),
+                 _rule('10.0.0.0/24', 200)]
+        self.assertEqual(_compact_sg_rules(rules),
+                         [_rule('10.0.0.0/24', 80, 101),
+                          _rule('10.0.0.0/24', 200)])
+
+    def test_keeps_ports_of_other_sources_and_protocols(self):
+        rules = [_rule('10.0.0.0/24', 80),
+                 _rule('10.0.1.0/25', 81),
+                 _rule('10.0.0.0/24', 81, protocol='udp')]
+        self.assertEqual(_compact_sg_rules(rules), sorted(rules))
+
+    def test_merges_networks_with_the_same_ports(self):
+        rules = [_rule('10.0.0.0/25'),
+                 _rule('10.0.0.128/25'),
+                 _rule('10.0.0.7/32'),
+                 _rule('10.0.0.0/25', 443)]
+        self.assertEqual(_compact_sg_rules(rules),
+                         sorted([_rule('10.0.0.0/24'),
+                                 _rule('10.0.0.0/25', 443)]))
+
+    def test_coalesces_ports_before_merging_networks(self):
+        rules = [_rule('10.0.0.0/25', 80, 81),
+                 _rule('10.0.0.128/25', 80),
+                 _rule('10.0.0.128/25', 81)]
+        self.assertEqual(_compact_sg_rules(rules),
+                         [_rule('10.0.0.0/24', 80, 81)])
+
+    def test_keeps_group_and_icmp_rules(self):
+        rules = [SecurityGroupRule.normalized('tcp', 22, 22,
+                                              remote_group_id='sg-1'),
+                 _rule('10.0.0.0/24', -1, protocol='icmp')]
+        self.assertEqual(_compact_sg_rules(rules), sorted(rules))
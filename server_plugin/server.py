@@ -16,52 +16,217 @@
 
 import copy
 from cloudify.decorators import operation
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 from libcloud_plugin_common import (with_server_client,
                                     get_floating_ip_client,
                                     provider,
-                                    transform_resource_name)
+                                    transform_resource_name,
+                                    WaitStrategy,
+                                    LIBCLOUD_REGION_PROPERTY)
+from libcloud_plugin_common.regions import is_capacity_error, region_stats
 
 
 LIBCLOUD_SERVER_ID_PROPERTY = 'libcloud_server_id'
+LIBCLOUD_WAIT_PROPERTY = 'libcloud_wait'
+LIBCLOUD_TERMINATING_PROPERTY = 'libcloud_terminating'
 TIMEOUT = 120
 SLEEP_TIME = 5
+# Plugin resources that are only managed in cloud_provider_name
+SINGLE_REGION_NODE_TYPES = ('cloudify.libcloud.nodes.SecurityGroup',
+                            'cloudify.libcloud.nodes.FloatingIP')
 
 
-def start_new_server(ctx, server_client, **kwargs):
-    provider_context = provider(ctx)
-
+def _server_context(ctx):
     server = {
         'name': ctx.instance.id
     }
     server.update(copy.deepcopy(ctx.node.properties['server']))
     transform_resource_name(server, ctx)
+    return server
+
+
+def _resolve_launch_parameters(server_client, server_context):
+    # Invalid parameters only matter once a server is launched; create()
+    # resolves them again then and raises.
+    try:
+        return server_client.resolve_launch_parameters(server_context)
+    except NonRecoverableError:
+        return None
+
+
+def start_new_server(ctx,
+                     server_client,
+                     server_context=None,
+                     launch_parameters=None,
+                     **kwargs):
+    provider_context = provider(ctx)
+
+    if server_context is None:
+        server_context = _server_context(ctx)
 
     ctx.logger.info("Creating VM")
 
     server = server_client.create(ctx.instance.id,
                                   ctx,
-                                  server,
-                                  provider_context)
-    server_client.wait_for_server_to_be_running(server, TIMEOUT, SLEEP_TIME)
-
+                                  server_context,
+                                  provider_context,
+                                  launch_parameters=launch_parameters)
     ctx.instance.runtime_properties[LIBCLOUD_SERVER_ID_PROPERTY] = server.id
 
+    _wait_for_server(ctx, server_client, server, 'running')
+
+
+def _wait_for_server(ctx, server_client, server, target):
+    # With non_blocking_waits the operation is retried instead of sleeping,
+    # and the wait resumes from the state kept in runtime properties.
+    runtime_properties = ctx.instance.runtime_properties
+    pending = runtime_properties.get(LIBCLOUD_WAIT_PROPERTY) or {}
+    if pending.get('target') != target:
+        pending = {}
+    if LIBCLOUD_WAIT_PROPERTY in runtime_properties:
+        del runtime_properties[LIBCLOUD_WAIT_PROPERTY]
+
+    wait = WaitStrategy(TIMEOUT,
+                        SLEEP_TIME,
+                        blocking=not ctx.node.properties['non_blocking_waits'],
+                        deadline=pending.get('deadline'),
+                        attempt=pending.get('attempt', 0))
+    try:
+        if target == 'running':
+            server_client.wait_for_server_to_be_running(server, wait)
+        else:
+            server_client.wait_for_server_to_be_deleted(server, wait)
+    except RecoverableError:
+        runtime_properties[LIBCLOUD_WAIT_PROPERTY] = dict(target=target,
+                                                          **wait.to_dict())
+        raise
+
+
+def _is_waiting_for(ctx, target):
+    pending = ctx.instance.runtime_properties.get(LIBCLOUD_WAIT_PROPERTY)
+    return bool(pending) and pending.get('target') == target
+
 
 @operation
 @with_server_client
 def start(ctx, server_client, **kwargs):
-    server = get_server_by_context(server_client, ctx.instance)
+    known = LIBCLOUD_SERVER_ID_PROPERTY in ctx.instance.runtime_properties
+    if known:
+        server = get_server_by_context(server_client, ctx, ctx.instance)
+        server_context = launch_parameters = None
+    elif len(server_client.regions()) > 1:
+        _start_in_regions(ctx, server_client, **kwargs)
+        return
+    else:
+        # Most likely nothing was launched for this instance yet: look the
+        # server up by its tags while resolving its image and size
+        server_context = _server_context(ctx)
+        server, launch_parameters = server_client.run_concurrently(
+            lambda client: get_server_by_context(client, ctx, ctx.instance),
+            lambda client: _resolve_launch_parameters(client,
+                                                      server_context))
     if server is not None:
-        server_client.start_server(server)
+        if _is_waiting_for(ctx, 'running'):
+            _wait_for_server(ctx, server_client, server, 'running')
+        elif not known:
+            # Launched by an earlier attempt that failed before storing it
+            ctx.instance.runtime_properties[LIBCLOUD_SERVER_ID_PROPERTY] = \
+                server.id
+            _wait_for_server(ctx, server_client, server, 'running')
+        else:
+            server_client.start_server(server)
         return
 
-    start_new_server(ctx, server_client, **kwargs)
+    start_new_server(ctx,
+                     server_client,
+                     server_context=server_context,
+                     launch_parameters=launch_parameters,
+                     **kwargs)
+
+
+def _check_multi_region(ctx, server_client):
+    for relationship in ctx.instance.relationships:
+        types = set(relationship.target.node.type_hierarchy)
+        if types.intersection(SINGLE_REGION_NODE_TYPES):
+            raise NonRecoverableError(
+                "Server {0} cannot be placed in multiple regions: node {1} "
+                "it is related to only exists in {2}".format(
+                    ctx.instance.id,
+                    relationship.target.node.id,
+                    server_client.regions()[0]))
+
+
+def _resume_server(ctx, server_client, region, server):
+    runtime_properties = ctx.instance.runtime_properties
+    runtime_properties[LIBCLOUD_REGION_PROPERTY] = region
+    runtime_properties[LIBCLOUD_SERVER_ID_PROPERTY] = server.id
+    _wait_for_server(ctx, server_client.for_region(region), server,
+                     'running')
+
+
+def _start_in_regions(ctx, server_client, **kwargs):
+    # Multi-region mode: the inventories of all regions are queried at once
+    # for a server launched by an earlier attempt. Otherwise one is launched
+    # in the best ranked region, or in the next one on capacity errors.
+    _check_multi_region(ctx, server_client)
+    runtime_properties = ctx.instance.runtime_properties
+    previous = runtime_properties.get(LIBCLOUD_REGION_PROPERTY)
+    if previous is not None:
+        # An earlier attempt launched there; the launch journal finds its
+        # server even before it is tagged
+        server = get_server_by_context(server_client.for_region(previous),
+                                       ctx,
+                                       ctx.instance)
+        if server is not None:
+            _resume_server(ctx, server_client, previous, server)
+            return
+
+    placed = {}
+    for region, inventory in server_client.get_inventories(
+            ctx.deployment.id):
+        if inventory is None:
+            # The server may have been launched there: placing it elsewhere
+            # could launch a second one
+            raise RecoverableError('Region {0} is not available'
+                                   .format(region))
+        server = inventory['servers'].get(ctx.instance.id)
+        if server is not None:
+            _resume_server(ctx, server_client, region, server)
+            return
+        placed[region] = inventory['placed'].get(ctx.node.id, 0)
+
+    server_context = _server_context(ctx)
+    regions = region_stats.rank(list(placed), placed)
+    if previous in regions:
+        # Launching there again reuses the client token of the earlier
+        # attempt, which the other regions do not know
+        regions.remove(previous)
+        regions.insert(0, previous)
+    for region in regions:
+        ctx.logger.info("Placing server in region {0}".format(region))
+        runtime_properties[LIBCLOUD_REGION_PROPERTY] = region
+        try:
+            start_new_server(ctx,
+                             server_client.for_region(region),
+                             server_context=server_context,
+                             **kwargs)
+            return
+        except Exception as e:
+            # Nothing was launched, so the next region is safe to try
+            if not is_capacity_error(e):
+                raise
+            region_stats.record_capacity_error(region)
+            ctx.logger.warn('No capacity in region {0}: {1}'
+                            .format(region, e))
+    del runtime_properties[LIBCLOUD_REGION_PROPERTY]
+    raise RecoverableError('No capacity for the server in regions {0}'
+                           .format(', '.join(regions)))
 
 
 @operation
 @with_server_client
 def stop(ctx, server_client, **kwargs):
-    server = get_server_by_context(server_client, ctx.instance)
+    server = get_server_by_context(server_client, ctx, ctx.instance)
     if server is None:
         raise RuntimeError(
             "Cannot stop server - server doesn't exist for node: {0}"
@@ -72,18 +237,63 @@ def stop(ctx, server_client, **kwargs):
 @operation
 @with_server_client
 def delete(ctx, server_client, **kwargs):
-    server = get_server_by_context(server_client, ctx.instance)
+    if ctx.node.properties['async_delete']:
+        _delete_server_async(ctx, server_client)
+        return
+    server = get_server_by_context(server_client, ctx, ctx.instance)
     if server is None:
         return
-    server_client.delete_server(server)
-    server_client.wait_for_server_to_be_deleted(server, TIMEOUT, SLEEP_TIME)
+    if not _is_waiting_for(ctx, 'deleted'):
+        _delete_server(ctx, server_client, server)
+    _wait_for_server(ctx, server_client, server, 'deleted')
+
+
+def _delete_server(ctx, server_client, server):
+    # With batch_termination the terminations issued by concurrent deletes
+    # are sent together
+    server_client.delete_server(
+        server, batch=ctx.node.properties['batch_termination'])
+
+
+def _delete_server_async(ctx, server_client):
+    # Termination is issued once and the operation is then retried until
+    # the instance is seen terminated, instead of a worker sleeping on it.
+    # The checks of all instances being deleted are batched.
+    runtime_properties = ctx.instance.runtime_properties
+    terminating = runtime_properties.get(LIBCLOUD_TERMINATING_PROPERTY)
+    if terminating is None:
+        server = get_server_by_context(server_client, ctx, ctx.instance)
+        if server is None:
+            return
+        _delete_server(ctx, server_client, server)
+        terminating = {'id': server.id}
+    elif server_client.is_server_terminated(terminating['id']):
+        del runtime_properties[LIBCLOUD_TERMINATING_PROPERTY]
+        return
+
+    wait = WaitStrategy(TIMEOUT,
+                        SLEEP_TIME,
+                        blocking=False,
+                        deadline=terminating.get('deadline'),
+                        attempt=terminating.get('attempt', 0))
+    if wait.expired():
+        raise RuntimeError('Server {0} has not obtained state {1}.'
+                           ' Waited for {2} seconds'
+                           .format(terminating['id'], 'terminated',
+                                   wait.timeout))
+    try:
+        wait.sleep('Waiting for server {0} to be terminated'
+                   .format(terminating['id']))
+    finally:
+        runtime_properties[LIBCLOUD_TERMINATING_PROPERTY] = dict(
+            id=terminating['id'], **wait.to_dict())
 
 
 @operation
 @with_server_client
 def get_state(ctx, server_client, **kwargs):
     ctx.logger.info("Try to get server state")
-    server = get_server_by_context(server_client, ctx.instance)
+    server = get_server_by_context(server_client, ctx, ctx.instance)
     if server_client.is_server_active(server):
         ctx.logger.info("Server \'{0}\' is active".format(server.name))
         ips = {}
@@ -95,11 +305,18 @@ def get_state(ctx, server_client, **kwargs):
     return False
 
 
+@operation
+@with_server_client
+def refresh_size_catalog(ctx, server_client, **kwargs):
+    sizes = server_client.refresh_size_catalog()
+    ctx.logger.info("Refreshed size catalog: {0}".format(sorted(sizes)))
+
+
 @operation
 @with_server_client
 def connect_floating_ip(ctx, server_client, **kwargs):
     ctx.logger.info("Try to connect floating IP")
-    server = get_server_by_context(server_client, ctx.source.instance)
+    server = get_server_by_context(server_client, ctx, ctx.source.instance)
     if server is None:
         raise RuntimeError(
             "Cannot connect floating IP to the server"
@@ -133,8 +350,8 @@ def disconnect_floating_ip(ctx, server_client, **kwargs):
     server_client.disconnect_floating_ip(floating_ip)
 
 
-def get_server_by_context(server_client, node_instance):
+def get_server_by_context(server_client, ctx, node_instance):
     if LIBCLOUD_SERVER_ID_PROPERTY in node_instance.runtime_properties:
         return server_client.get_by_id(
             node_instance.runtime_properties[LIBCLOUD_SERVER_ID_PROPERTY])
-    return server_client.get_by_name(node_instance.id)
+    return server_client.get_by_instance(ctx.deployment.id, node_instance.id)